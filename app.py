@@ -1,55 +1,112 @@
 import os
+import asyncio
+import json
+import logging
+import time
 import uuid
 import base64
-import uvicorn
-from fastapi import FastAPI, HTTPException, Response
+import binascii
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from pydantic import BaseModel, Field, ValidationError
+from typing import Callable, Literal, Optional, List, Tuple
 from dotenv import load_dotenv   # ✅ Add this
 
 # Required libraries: pip install google-generativeai Pillow httpx aiofiles python-dotenv
-import google.generativeai as genai
-from PIL import Image
-from io import BytesIO
-import httpx
+# google.generativeai and httpx are imported on first use (see model_clients.py and image_proxy.py)
+# so a cold start only pays for what its first request needs.
+from PIL import Image, UnidentifiedImageError
 import re
 
-# --- 1. Configuration (Unchanged except API loading) ---
-# IMAGE_DIR = "gallery_images"
-# os.makedirs(IMAGE_DIR, exist_ok=True)
+from avatars import Avatar, AvatarStore
+from brief_cache import BriefCache
+from fake_backend import fake_models_from_env
+from image_proxy import ImageProxy, ProxyError
+from log_setup import configure_logging
+from metrics import BYTES_BUCKETS, Registry
+from model_clients import LazyModel
+from jobs import JobRecord, JobRunner, QueueFull
+from imaging import (ImageRejected, NormalizeSettings, OutputEncoding, OutputSettings, describe_savings, encode_output,
+                     normalize_images, unique_images)
+from product_briefs import ProductBriefStore
+from prompt_cache import PromptCache, PromptTemplate
+from resilience import CircuitOpenError, ResilientCaller, UpstreamTimeout, is_retryable
+from scheduler import RateLimited, RateScheduler, current_client, current_priority
+from result_store import ResultStore, StoredResult
+from singleflight import SingleFlight, request_key
+from timing import StageTimer
+from uploads import UploadLimits, UploadRejected, read_multipart_images
+from worker_pool import ModelWorkerPool, PoolSaturatedError
 
+# --- 1. Configuration (Unchanged except API loading) ---
 # ✅ Load .env variables
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 
-if not api_key:
+# ✅ TRYON_BACKEND=gemini (default) calls Gemini; TRYON_BACKEND=fake uses the offline
+# fake models from fake_backend.py (FAKE_* settings) so the service runs without API keys.
+MODEL_BACKEND = os.getenv("TRYON_BACKEND", "gemini").lower()
+if MODEL_BACKEND not in ("gemini", "fake"):
+    raise RuntimeError(f"Unknown TRYON_BACKEND {MODEL_BACKEND!r}; use 'gemini' or 'fake'")
+
+if MODEL_BACKEND == "gemini" and not api_key:
     raise RuntimeError("GEMINI_API_KEY not set in .env file")
 
-# ✅ Configure Gemini
-genai.configure(api_key=api_key)
+# ✅ Logging goes through a queue so request handlers never block on stderr.
+# LOG_LEVEL sets app logging; PROMPT_LOG_LEVEL=INFO turns on full prompt/brief logging.
+log_listener = configure_logging()
+log = logging.getLogger("tryon")
+prompt_log = logging.getLogger("tryon.prompts")
 
 # --- 2. Pydantic Models (Unchanged) ---
-class TryOnPayload(BaseModel):
-    personImage: str
-    productImage: str
+class TryOnDetails(BaseModel):
+    # The text half of a try-on request, shared by the JSON and multipart endpoints.
     productName: str
     productSize: str
     productDesc: str
     tone: Optional[str] = None
     style: Optional[str] = None
+    productId: Optional[str] = Field(None, description="Catalog id of a product whose brief was stored via POST /products/briefs.")
+    avatarId: Optional[str] = Field(None, description="A person registered via POST /avatars, sent instead of personImage.")
+    briefMode: Literal["full", "precomputed", "avatar"] = Field(
+        "full", description="full: run Step 1. precomputed: use the stored product brief and skip Step 1. "
+                            "avatar: stored product brief plus a short avatar-only analysis. With a registered "
+                            "avatarId whose analysis is ready, Step 1 only ever describes the product.")
+    latencyMode: Literal["quality", "fast"] = Field(
+        "quality", description="fast: if the Step-1 brief is not ready within SPECULATION_BUDGET seconds, Step 2 also "
+                               "starts on a stored product brief or the generic fallback, and the first image back is returned.")
+
+class TryOnPayload(TryOnDetails):
+    personImage: Optional[str] = None
+    productImage: str
 
 class TryOnResponse(BaseModel):
     imageUrl: str = Field(..., description="The public URL of the newly generated image.")
 
-# --- 3. FastAPI Application Setup (Unchanged) ---
+# --- 3. FastAPI Application Setup ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ✅ WARMUP_ON_STARTUP=1 builds the model clients in the background while the server already listens.
+    warmup = asyncio.create_task(warm_up()) if os.getenv("WARMUP_ON_STARTUP", "0").lower() in ("1", "true", "yes") else None
+    yield
+    if warmup is not None:
+        warmup.cancel()
+    await job_runner.close()
+    await image_proxy.close()
+    if result_store is not None:
+        result_store.close()
+    model_pool.shutdown()
+    normalize_settings.shutdown()
+    log_listener.stop()
+
 app = FastAPI(
     title="AI Virtual Try-On API (Personal Use)",
     description="Uses a two-step AI process to create a realistic, personal virtual try-on.",
-    version="10.0.0"
+    version="10.0.0",
+    lifespan=lifespan
 )
-# app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -58,145 +115,434 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- 4. AI Model Initialization (Unchanged) ---
-# This is your powerful image generation model
-image_generation_model = genai.GenerativeModel(model_name="gemini-2.5-flash-image-preview")
+# --- 4. AI Model Initialization ---
+if MODEL_BACKEND == "fake":
+    description_model, image_generation_model = fake_models_from_env()
+else:
+    # ✅ Built (and Gemini configured) on first use, or by the warm-up hook, not at import.
+    # This is your powerful image generation model
+    image_generation_model = LazyModel("gemini-2.5-flash-image-preview", api_key)
+
+    # This is the fast model for generating the text description
+    description_model = LazyModel("gemini-2.5-flash-lite", api_key)
+
+def set_model_clients(description=None, image=None):
+    """Swaps in other model clients (anything with a compatible generate_content), e.g. for benchmarks."""
+    global description_model, image_generation_model
+    if description is not None:
+        description_model = description
+    if image is not None:
+        image_generation_model = image
+
+# ✅ Both models are called through a bounded thread pool so the blocking SDK calls
+# never stall the event loop. Tune with MODEL_MAX_CONCURRENCY / MODEL_MAX_QUEUE / MODEL_QUEUE_TIMEOUT.
+model_pool = ModelWorkerPool.from_env()
+
+# ✅ Deadlines, jittered retries, optional Step-2 hedging and a circuit breaker per model.
+# STEP1_TIMEOUT / STEP2_TIMEOUT (one deadline per stage, shared by its retries; timeouts are not
+# retried), MODEL_RETRIES, MODEL_RETRY_BACKOFF, STEP2_HEDGE=1 (with
+# MODEL_HEDGE_MIN_DELAY), BREAKER_FAILURES / BREAKER_RESET_SECONDS.
+# ✅ Each model's RPM/TPM quota is paced by its own token buckets (DESCRIPTION_RPM / DESCRIPTION_TPM,
+# IMAGE_RPM / IMAGE_TPM; 0 = unlimited). Interactive requests go before batch and precompute work,
+# clients (by address) take turns, and a call that would wait longer than SCHEDULER_MAX_WAIT is
+# refused with 429 + Retry-After. X-Client-Id is client-supplied, so a caller could take a fresh turn
+# per request with a random id; it is only used as the client key with TRUST_CLIENT_ID=1, for
+# deployments where a trusted gateway sets (and overwrites) it per tenant.
+TRUST_CLIENT_ID = os.getenv("TRUST_CLIENT_ID", "0").lower() in ("1", "true", "yes")
+description_calls = ResilientCaller.from_env(
+    model_pool, "description model", "step1", default_timeout=30,
+    scheduler=RateScheduler.from_env("description model", "DESCRIPTION", output_tokens=1000),
+)
+image_calls = ResilientCaller.from_env(
+    model_pool, "image model", "step2", default_timeout=120,
+    scheduler=RateScheduler.from_env("image model", "IMAGE", output_tokens=1290),
+)
 
-# This is the fast model for generating the text description
-description_model = genai.GenerativeModel(model_name='gemini-2.5-flash-lite')
+def saturated_exception(e: PoolSaturatedError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+async def admit_tryon_request():
+    # Rejects with 429 + Retry-After once too many try-on requests are already in the pipeline.
+    try:
+        async with model_pool.admit():
+            yield
+    except PoolSaturatedError as e:
+        raise saturated_exception(e)
+
+# ✅ Step-1 briefs are cached by image/product content so retries skip the description call.
+# Bump a version whenever its meta-prompt text changes so stale briefs are never reused.
+META_PROMPT_VERSION = "test_for_better-v1"
+META_PROMPT_MULTI_IMAGE_VERSION = "multi_image-v1"
+
+# ✅ The Step-1 meta-prompts' static instructions are registered once as Gemini cached content
+# (PROMPT_CACHE=0 sends them inline as before; PROMPT_CACHE_TTL sets the cache lifetime).
+prompt_cache = PromptCache.from_env()
+brief_cache = BriefCache.from_env()
+
+# ✅ latencyMode=fast streams the Step-1 brief and gives it SPECULATION_BUDGET seconds; after that
+# Step 2 also starts speculatively without it and the first image back is returned.
+SPECULATION_BUDGET = float(os.getenv("SPECULATION_BUDGET", "4"))
+
+# ✅ Product-side briefs computed ahead of time (POST /products/briefs) so briefMode=precomputed|avatar
+# can skip the full Step-1 call. Stored in memory, or in SQLite when PRODUCT_BRIEF_DB is set.
+PRODUCT_BRIEF_VERSION = "product_brief-v1"
+AVATAR_ANALYSIS_VERSION = "avatar_analysis-v1"
+product_briefs = ProductBriefStore.from_env()
+
+# ✅ Registered avatars (POST /avatars): the normalized photo plus its pose/lighting analysis, so
+# returning users send an avatarId instead of megabytes of base64. AVATAR_CACHE_MAX_BYTES, AVATAR_DB.
+avatar_store = AvatarStore.from_env()
+
+# ✅ Limits for uploaded images, multipart and base64 alike (UPLOAD_MAX_FILE_BYTES / UPLOAD_MAX_TOTAL_BYTES / UPLOAD_MAX_FILES).
+upload_limits = UploadLimits.from_env()
+
+# ✅ Every image is normalized once per request (EXIF rotation, max edge, one re-encode)
+# and the same bytes are sent to Step 1 and Step 2. See IMAGE_MAX_EDGE / IMAGE_FORMAT / IMAGE_QUALITY.
+# IMAGE_MAX_PIXELS caps dimensions (checked from the header), IMAGE_DECODE_WORKERS sizes the decode pool.
+normalize_settings = NormalizeSettings.from_env()
+
+# ✅ Generated images are returned as PNG unless the client asks for WebP/AVIF/JPEG via Accept or
+# ?format= (plus ?quality= and ?maxEdge=). OUTPUT_FORMATS sets the preference order, OUTPUT_QUALITY the default.
+output_settings = OutputSettings.from_env()
+
+# ✅ One app-lifetime HTTP client and response cache for /proxy-image
+# (PROXY_MAX_BYTES / PROXY_CACHE_MAX_BYTES / PROXY_CACHE_TTL).
+image_proxy = ImageProxy.from_env()
+
+# ✅ Generated images can be kept on disk (opt-in: set RESULT_DIR, e.g. gallery_images; unset on read-only
+# filesystems such as Vercel's), content-addressed and indexed in SQLite, with thumbnails and size-based
+# eviction (RESULT_STORE_MAX_BYTES). Identical repeated requests are then answered from the store.
+result_store = ResultStore.from_env()
+
+# --- 4b. Metrics (Prometheus text format at /metrics) ---
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter("http_requests_total", "HTTP requests by route and status.", ["method", "path", "status"])
+HTTP_LATENCY = metrics.histogram("http_request_duration_seconds", "Time to response headers, by route.", ["path"])
+STAGE_LATENCY = metrics.histogram("tryon_stage_duration_seconds", "Try-on pipeline stage durations.", ["endpoint", "stage"])
+BRIEF_SOURCES = metrics.counter("tryon_briefs_total", "Step-1 briefs by source (model, cache, precomputed, fallback).", ["endpoint", "source"])
+SPECULATION = metrics.counter("tryon_speculation_total", "latencyMode=fast try-ons by outcome: brief_in_budget, "
+                              "speculative_won, brief_won, failed.", ["endpoint", "outcome"])
+SPECULATION_SAVED = metrics.counter("tryon_speculation_saved_seconds_total", "Latency saved by speculative wins: how much "
+                                    "later the brief (and so the regular Step 2) would have started.", ["endpoint"])
+SPECULATION_DUPLICATES = metrics.counter("tryon_speculation_duplicate_calls_total", "Upstream image calls made for the "
+                                         "second Step 2 on the model's brief; a losing call still runs to completion.", ["endpoint"])
+BRIEF_FIRST_CHUNK = metrics.histogram("tryon_brief_first_chunk_seconds", "Time to the first streamed chunk of a Step-1 brief.", ["template"])
+BLOCK_REASONS = metrics.counter("tryon_blocked_total", "Step-2 calls that returned no image, by block reason.", ["reason"])
+PAYLOAD_BYTES = metrics.histogram("tryon_payload_bytes", "Image bytes received and returned per try-on.", ["endpoint", "direction"], BYTES_BUCKETS)
+PROXY_LATENCY = metrics.histogram("proxy_image_fetch_seconds", "Time to first byte for /proxy-image, by cache status.", ["cache"])
+metrics.gauge("model_pool_requests", "Try-on requests admitted and model calls running.", ["state"],
+              lambda: {("admitted",): model_pool.admitted, ("active",): model_pool.active})
+metrics.gauge("model_pool_rejected_total", "Requests rejected because the model pool was saturated.", [],
+              lambda: {(): model_pool.rejected}, kind="counter")
+metrics.gauge("model_calls_total", "Model calls and their retries, timeouts, hedges and short-circuits.", ["model", "event"],
+              lambda: {(caller.name, name): value for caller in (description_calls, image_calls)
+                       for name, value in caller.counters.items()}, kind="counter")
+metrics.gauge("circuit_breaker_open", "1 while a model's circuit breaker is refusing calls (open or half-open).", ["model"],
+              lambda: {(caller.name,): int(caller.breaker.state != "closed") for caller in (description_calls, image_calls)})
+metrics.gauge("rate_scheduler_calls_total", "Model calls admitted immediately, admitted after waiting for rate budget, or rejected.",
+              ["model", "event"], lambda: {(caller.name, name): value for caller in (description_calls, image_calls)
+                                           for name, value in caller.scheduler.counters.items()}, kind="counter")
+metrics.gauge("rate_scheduler_queued", "Model calls waiting for rate budget.", ["model"],
+              lambda: {(caller.name,): caller.scheduler.queued() for caller in (description_calls, image_calls)})
+metrics.gauge("prompt_calls_total", "Step-1 calls per meta-prompt template, with the instructions cached or sent inline.",
+              ["template", "mode"], lambda: {(t, m): v for (t, m, name), v in list(prompt_cache.counters.items())
+                                             if name == "calls"}, kind="counter")
+metrics.gauge("prompt_call_seconds_total", "Time spent in Step-1 calls per template and mode.", ["template", "mode"],
+              lambda: {(t, m): v for (t, m, name), v in list(prompt_cache.counters.items()) if name == "seconds"},
+              kind="counter")
+metrics.gauge("prompt_tokens_total", "Step-1 tokens per template and mode: prompt (incl. cached), cached, output.",
+              ["template", "mode", "kind"],
+              lambda: {(t, m, name[:-len("_tokens")]): v for (t, m, name), v in list(prompt_cache.counters.items())
+                       if name.endswith("_tokens")}, kind="counter")
+metrics.gauge("brief_cache_events_total", "Step-1 brief cache lookups and stores.", ["event"],
+              lambda: {(name,): value for name, value in brief_cache.counters.items()}, kind="counter")
+metrics.gauge("avatar_store_events_total", "Registered avatar lookups, stores and in-memory evictions.", ["event"],
+              lambda: {(name,): value for name, value in avatar_store.counters.items()}, kind="counter")
+metrics.gauge("avatar_cache_bytes", "Bytes of normalized avatar images held in memory.", [], lambda: {(): avatar_store.total_bytes})
+metrics.gauge("product_brief_events_total", "Precomputed product brief lookups and stores.", ["event"],
+              lambda: {(name,): value for name, value in product_briefs.counters.items()}, kind="counter")
+metrics.gauge("proxy_cache_events_total", "/proxy-image cache outcomes.", ["event"],
+              lambda: {(name,): value for name, value in image_proxy.cache.counters.items()}, kind="counter")
+metrics.gauge("proxy_cache_bytes", "Bytes held in the /proxy-image cache.", [], lambda: {(): image_proxy.cache.total_bytes})
+if result_store is not None:
+    metrics.gauge("result_store_events_total", "Stored try-on results: request lookups, stores and evictions.", ["event"],
+                  lambda: {(name,): value for name, value in result_store.counters.items()}, kind="counter")
+    metrics.gauge("result_store_bytes", "Bytes of images and thumbnails in the result store.", [], lambda: {(): result_store.total_bytes})
+metrics.gauge("singleflight_calls_total", "Try-on computations started (leaders) and requests that joined one (coalesced).",
+              ["role"], lambda: {(name,): value for name, value in tryon_flights.counters.items()}, kind="counter")
+
+@app.middleware("http")
+async def record_http_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    # Rate-limit fairness is per client: the caller's address, or the gateway's X-Client-Id when trusted.
+    client_id = request.headers.get("x-client-id") if TRUST_CLIENT_ID else None
+    current_client.set(client_id or (request.client.host if request.client else "anonymous"))
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    HTTP_REQUESTS.inc(method=request.method, path=path, status=str(response.status_code))
+    HTTP_LATENCY.observe(time.perf_counter() - started, path=path)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # --- 5. API Endpoints (All endpoints except /generate are unchanged) ---
 @app.get("/proxy-image")
 async def proxy_image(url: str):
-    # This function is unchanged.
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-        "Referer": "https://www.google.com/"
-    }
-    async with httpx.AsyncClient() as client:
+    # ✅ Shared keep-alive client, hard byte cap, and an LRU cache with ETag/Last-Modified revalidation.
+    started = time.perf_counter()
+    try:
+        image = await image_proxy.fetch(url)
+    except ProxyError as e:
+        PROXY_LATENCY.observe(time.perf_counter() - started, cache="ERROR")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    PROXY_LATENCY.observe(time.perf_counter() - started, cache=image.cache_status)
+
+    headers = {"X-Proxy-Cache": image.cache_status,
+               "Cache-Control": image.cache_control or f"public, max-age={int(image_proxy.default_ttl)}"}
+    if image.content is not None:
+        return Response(content=image.content, media_type=image.content_type, headers=headers)
+    if image.content_length:
+        headers["Content-Length"] = image.content_length
+    return StreamingResponse(image.stream, media_type=image.content_type, headers=headers)
+
+@app.get("/proxy-image/stats")
+async def proxy_image_stats():
+    return image_proxy.cache.stats()
+
+@app.get("/singleflight/stats")
+async def singleflight_stats():
+    return tryon_flights.stats()
+
+async def warm_up() -> dict:
+    # Pays the first-use costs now instead of in a shopper's request: the Gemini SDK import and
+    # model clients, the prompt cache registrations, and the proxy's HTTP client. Returns how long each took, in ms.
+    timings = {}
+    try:
+        for name, model in (("description_model", description_model), ("image_model", image_generation_model)):
+            if isinstance(model, LazyModel):
+                started = time.perf_counter()
+                await asyncio.to_thread(model.load)
+                timings[name] = round((time.perf_counter() - started) * 1000, 1)
+        started = time.perf_counter()
+        for template in (SHOT_BRIEF_TEMPLATE, MULTI_IMAGE_TEMPLATE):
+            await asyncio.to_thread(prompt_cache.prepare, description_model, template)
+        timings["prompt_cache"] = round((time.perf_counter() - started) * 1000, 1)
+        started = time.perf_counter()
+        image_proxy.client
+        timings["proxy_client"] = round((time.perf_counter() - started) * 1000, 1)
+    except Exception as e:
+        log.warning("Warm-up failed; clients will be built on first use instead. Error: %s", e)
+    return timings
+
+@app.post("/warmup")
+async def warmup_endpoint():
+    # For platforms without lifespan events: point a scheduled ping or a deploy hook here.
+    return await warm_up()
+
+@app.get("/resilience/stats")
+async def resilience_stats():
+    return {"description": description_calls.stats(), "image": image_calls.stats()}
+
+@app.get("/prompt-cache/stats")
+async def prompt_cache_stats():
+    return prompt_cache.stats()
+
+@app.get("/brief-cache/stats")
+async def brief_cache_stats():
+    return brief_cache.stats()
+
+class GalleryItem(BaseModel):
+    id: str
+    url: str
+    thumbnailUrl: str
+    productName: Optional[str] = None
+    createdAt: float
+    bytes: int
+
+class GalleryPage(BaseModel):
+    items: List[GalleryItem]
+    nextCursor: Optional[str] = Field(None, description="Pass as ?cursor= to get the next (older) page.")
+
+async def get_result_or_404(result_id: str) -> StoredResult:
+    result = await asyncio.to_thread(result_store.get, result_id) if result_store is not None else None
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found.")
+    return result
+
+def stored_file_response(request: Request, path: str, etag: str, media_type: str, vary: bool = False,
+                         extra_headers: Optional[dict] = None) -> Response:
+    # Results are content-addressed, so a URL's bytes never change and can be cached forever.
+    headers = {**(extra_headers or {}), "ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if vary:
+        headers["Vary"] = "Accept"
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+def output_encoding(request: Request,
+                    output_format: Optional[Literal["png", "jpeg", "webp", "avif"]] = Query(
+                        None, alias="format", description="Output format; default negotiated from Accept, else PNG."),
+                    quality: Optional[int] = Query(None, ge=1, le=100, description="Quality for JPEG/WebP/AVIF."),
+                    maxEdge: Optional[int] = Query(None, ge=64, le=4096, description="Downscale so neither side exceeds this.")
+                    ) -> OutputEncoding:
+    try:
+        return output_settings.negotiate(request.headers.get("accept", ""), output_format, quality, maxEdge)
+    except ValueError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+async def stored_variant_path(result: StoredResult, encoding: OutputEncoding) -> str:
+    try:
+        return await asyncio.to_thread(result_store.variant, result, encoding)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Result not found.")
+
+@app.get("/gallery", response_model=GalleryPage)
+async def get_gallery(limit: int = 24, cursor: Optional[str] = None):
+    # ✅ Newest first, paged through the SQLite index instead of listing and stat-ing the directory.
+    if result_store is None:
+        return GalleryPage(items=[])
+    before = None
+    if cursor:
+        created_at, _, digest = cursor.partition("_")
         try:
-            response = await client.get(url, follow_redirects=True, timeout=15, headers=headers)
-            response.raise_for_status()
-            content_type = response.headers.get('content-type', '')
-            if not content_type.startswith("image/"):
-                raise HTTPException(status_code=400, detail="URL is not a direct image link.")
-            return Response(content=response.content, media_type=content_type)
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=f"Image server error: {e.response.status_code}")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=400, detail=f"Failed to fetch image: {e}")
-
-# @app.get("/gallery", response_model=List[str])
-# async def get_gallery():
-#     # This function is unchanged.
-#     try:
-#         files = [f for f in os.listdir(IMAGE_DIR) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-#         files.sort(key=lambda x: os.path.getmtime(os.path.join(IMAGE_DIR, x)), reverse=True)
-#         base_url = "http://127.0.0.1:8000/images"
-#         return [f"{base_url}/{f}" for f in files]
-#     except Exception as e:
-#         raise HTTPException(status_code=500, detail=f"Could not retrieve gallery: {e}")
+            before = (float(created_at), digest)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+    limit = max(1, min(limit, 100))
+    results = await asyncio.to_thread(result_store.page, limit, before)
+    items = [GalleryItem(id=r.digest, url=f"/results/{r.digest}", thumbnailUrl=f"/results/{r.digest}/thumbnail",
+                         productName=r.product_name, createdAt=r.created_at, bytes=r.size_bytes) for r in results]
+    next_cursor = f"{results[-1].created_at!r}_{results[-1].digest}" if len(results) == limit else None
+    return GalleryPage(items=items, nextCursor=next_cursor)
+
+@app.get("/results/{result_id}", response_class=Response, responses={200: {"content": {"image/png": {}, "image/webp": {}, "image/avif": {}, "image/jpeg": {}}}})
+async def get_result_image(result_id: str, request: Request, encoding: OutputEncoding = Depends(output_encoding)):
+    result = await get_result_or_404(result_id)
+    if encoding.is_original:
+        return stored_file_response(request, result.path, f'"{result.digest}"', "image/png", vary=True)
+    path = await stored_variant_path(result, encoding)
+    return stored_file_response(request, path, f'"{result.digest}-{encoding.key}"', encoding.mime_type, vary=True)
+
+@app.get("/results/{result_id}/thumbnail", response_class=Response, responses={200: {"content": {"image/jpeg": {}}}})
+async def get_result_thumbnail(result_id: str, request: Request):
+    result = await get_result_or_404(result_id)
+    path = await asyncio.to_thread(result_store.thumbnail, result)
+    return stored_file_response(request, path, f'"{result.digest}-thumb"', "image/jpeg")
+
+def decode_base64_image(data: str, field: str) -> bytes:
+    # Base64 is 4 chars per 3 bytes, so the size limit is checked before decoding anything.
+    if len(data) * 3 // 4 > upload_limits.max_file_bytes:
+        raise HTTPException(status_code=413, detail=f"{field} exceeds {upload_limits.max_file_bytes // (1024 * 1024)} MB.")
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"{field} is not valid base64: {e}")
+
+def decode_base64_images(images: List[str], field: str, person_bytes: Optional[bytes] = None) -> List[bytes]:
+    # The JSON counterpart of the multipart limits, which count an uploaded person image (passed
+    # as person_bytes) like any other file; identical images are only sent to the model once.
+    count = len(images) + (person_bytes is not None)
+    if count > upload_limits.max_files:
+        raise HTTPException(status_code=413, detail=f"Too many images; at most {upload_limits.max_files} are allowed.")
+    total_bytes = sum(len(data) for data in images) * 3 // 4 + len(person_bytes or b"")
+    if total_bytes > upload_limits.max_total_bytes:
+        raise HTTPException(status_code=413,
+                            detail=f"Images exceed {upload_limits.max_total_bytes // (1024 * 1024)} MB in total.")
+    return unique_images([decode_base64_image(data, field) for data in images])
+
+async def read_tryon_form(request: Request, file_fields: List[str]):
+    # Streams a multipart try-on upload; size/count/format limits are enforced while reading.
+    try:
+        fields, files = await read_multipart_images(request, file_fields, upload_limits)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    try:
+        details = TryOnDetails(**fields)
+        missing = [name for name in file_fields if not files.get(name) and not (name == "personImage" and details.avatarId)]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"Missing image field(s): {', '.join(missing)}")
+    except ValidationError as e:
+        close_uploads(files)
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    except HTTPException:
+        close_uploads(files)
+        raise
+    return details, files
+
+def resolve_person(person_bytes: Optional[bytes], avatar_id: Optional[str]) -> Tuple[bytes, Optional[Avatar]]:
+    # Every try-on takes exactly one of an uploaded person image or a registered avatar.
+    if (person_bytes is None) == (avatar_id is None):
+        raise HTTPException(status_code=422, detail="Provide exactly one of personImage or avatarId.")
+    if avatar_id is None:
+        return person_bytes, None
+    avatar = avatar_store.get(avatar_id)
+    if avatar is None:
+        raise HTTPException(status_code=404, detail="Unknown avatarId; register the photo again via POST /avatars.")
+    return avatar.image.data, avatar
+
+def resolve_payload_person(payload) -> Tuple[bytes, Optional[Avatar]]:
+    person_bytes = decode_base64_image(payload.personImage, "personImage") if payload.personImage else None
+    return resolve_person(person_bytes, payload.avatarId)
+
+def close_uploads(files):
+    for uploads in files.values():
+        for upload in uploads:
+            upload.close()
+
+def multipart_openapi(file_fields: dict) -> dict:
+    # Documents the manually-parsed multipart body in /docs.
+    properties = {name: {"type": "string"} for name in TryOnDetails.model_fields}
+    for name, many in file_fields.items():
+        file_schema = {"type": "string", "format": "binary"}
+        properties[name] = {"type": "array", "items": file_schema} if many else file_schema
+    # personImage may be replaced by an avatarId field
+    required = [name for name, field in TryOnDetails.model_fields.items() if field.is_required()]
+    required += [name for name in file_fields if name != "personImage"]
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {
+        "schema": {"type": "object", "properties": properties, "required": required}}}}}
+
+IMAGE_RESPONSE = {
+    200: {
+        "content": {"image/png": {}, "image/webp": {}, "image/avif": {}, "image/jpeg": {}},
+        "description": "The generated try-on image: PNG, or the format asked for via Accept / ?format=."
+    }
+}
 
 @app.post("/generate",
     # Use response_class for direct Response objects like images
     response_class=Response,
     # Add OpenAPI documentation for what this endpoint returns
-    responses={
-        200: {
-            "content": {"image/png": {}},
-            "description": "The generated try-on image in PNG format."
-        }
-    }
+    responses=IMAGE_RESPONSE
 )
-async def generate_tryon(payload: TryOnPayload):
+async def generate_tryon(payload: TryOnPayload, request: Request, encoding: OutputEncoding = Depends(output_encoding),
+                         _admitted: None = Depends(admit_tryon_request)):
+    person_bytes, avatar = resolve_payload_person(payload)
+    product_bytes = decode_base64_image(payload.productImage, "productImage")
+    return await tryon_response(request, person_bytes, [product_bytes], payload, encoding, avatar=avatar)
+
+@app.post("/generate/upload", response_class=Response, responses=IMAGE_RESPONSE,
+          openapi_extra=multipart_openapi({"personImage": False, "productImage": False}))
+async def generate_tryon_upload(request: Request, encoding: OutputEncoding = Depends(output_encoding),
+                                _admitted: None = Depends(admit_tryon_request)):
+    # ✅ Same pipeline as /generate, but the images arrive as streamed multipart file parts.
+    details, files = await read_tryon_form(request, ["personImage", "productImage"])
     try:
-        person_image = Image.open(BytesIO(base64.b64decode(payload.personImage)))
-        product_image = Image.open(BytesIO(base64.b64decode(payload.productImage)))
-
-        style_instructions = []
-        if payload.tone: style_instructions.append(f"- Desired Tone: {payload.tone}")
-        if payload.style: style_instructions.append(f"- Rendering Style: {payload.style}")
-
-        # =================================================================
-        # === STEP 1: AI AS A MASTER PROMPT ENGINEER ===
-        # =================================================================
-        ai_generated_dynamic_prompt = "" # Fallback
-        try:
-  
-  
-            # meta_prompt = meta_prompt_1_production_ready
-            meta_prompt = meta_prompt_test_for_better(payload.productDesc)
-            print(payload.productDesc, "\n")
-
-
-            # Call the description model to generate the entire new prompt.
-            description_response = description_model.generate_content(
-                [meta_prompt, person_image, product_image],
-                generation_config={"temperature": 0.2} # Temp allows for creative descriptions of fabric physics
-            )
-            ai_generated_dynamic_prompt = description_response.text.strip()
-            print("\n--- AI as Master Prompt Engineer Generated the Following ---")
-            print(ai_generated_dynamic_prompt)
-            print("-----------------------------------------------------------\n")
-            
-        except Exception as e:
-            print(f"WARNING: Dynamic prompt generation failed. Using basic fallback. Error: {e}")
-            ai_generated_dynamic_prompt = "## GOAL\nCreate an image of the avatar wearing the new clothing. Preserve the avatar's identity and the background."
-        # =================================================================
-        # === END OF STEP 1 ===
-        # =================================================================
-
-        # =================================================================
-        # === STEP 2: IMAGE GENERATION (Executing the master prompt) ===
-        # =================================================================
-        # The wrapper prompt is now a simple executor.
-        image_gen_prompt = f"""
-        You are a high-fidelity image synthesis engine. Your task is to execute the following technical instructions from an AI Specialist. Adhere to every rule with absolute precision.
-
-        {ai_generated_dynamic_prompt}
-
-        """
-
-        contents = [image_gen_prompt, person_image, product_image]
-        
-        # Low temperature for the final execution to ensure it follows the strict rules.
-        generation_config = {
-            "temperature": 0.2,
-            "candidate_count": 1
-        }
-        
-        response = image_generation_model.generate_content(
-            contents,
-            generation_config=generation_config
-        )
-        
-        generated_image_data = None
-        for part in response.candidates[0].content.parts:
-            if part.inline_data:
-                generated_image_data = part.inline_data.data
-                break
-                
-        if generated_image_data:
-            return Response(content=generated_image_data, media_type="image/png")
-        else:
-            block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
-            raise HTTPException(status_code=500, detail=f"Image generation failed. Reason: {block_reason}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
-    
- 
-class TryOnPayloadWithMultipleImages(BaseModel):
-    personImage: str = Field(..., description="A single Base64 encoded string of the person's image.")
+        person_bytes = files["personImage"][0].read_bytes() if files.get("personImage") else None
+        product_bytes = files["productImage"][0].read_bytes()
+    finally:
+        close_uploads(files)
+    person_bytes, avatar = resolve_person(person_bytes, details.avatarId)
+    return await tryon_response(request, person_bytes, [product_bytes], details, encoding, avatar=avatar)
+
+class TryOnPayloadWithMultipleImages(TryOnDetails):
+    personImage: Optional[str] = Field(None, description="A single Base64 encoded string of the person's image (or send avatarId).")
     productImages: List[str] = Field(..., description="A list of Base64 encoded strings for the product, showing different angles (e.g., front, back, detail).")
-    productName: str
-    productSize: str
-    productDesc: str
-    tone: Optional[str] = None
-    style: Optional[str] = None
 
 # This is the new "Master Blaster" meta-prompt, upgraded for multi-image analysis.
-meta_prompt_multi_image = f"""
+meta_prompt_multi_image_instructions = """
 **ROLE:** You are an AI Render Supervisor & 3D Garment Specialist. Your function is to generate a "Shot Execution Brief"—a master-level, technically flawless render instruction set for a subsequent, diffusion-based image synthesis engine. You do not create the final image; you write the unimpeachable technical blueprint that guarantees its perfection.
 
 **YOUR PRIMARY DIRECTIVE:**
@@ -234,71 +580,822 @@ KEY LIGHT: Match the hard, cool-white key light from the top-left on the jacket'
 CONTACT SHADOWS: Render high-quality, soft contact shadows where the jacket collar meets the t-shirt and where the back of the jacket presses against the brick wall.
 ---
 
-**YOUR TASK NOW:**
+"""
+
+meta_prompt_multi_image_task = """**YOUR TASK NOW:**
 Analyze the provided avatar image and the **collection** of product images. Generate a new, master-level Shot Execution Brief that follows the exact structure, technical language, and extraordinary level of detail demonstrated in the example. Your output must begin with `## RENDER INTENT`.
 """
 
-@app.post("/generate_multi_image", response_class=Response, responses={200: {"content": {"image/png": {}}}})
-async def generate_tryon_multi_image(payload: TryOnPayloadWithMultipleImages):
+meta_prompt_multi_image = meta_prompt_multi_image_instructions + meta_prompt_multi_image_task
+
+@app.post("/generate_multi_image", response_class=Response, responses=IMAGE_RESPONSE)
+async def generate_tryon_multi_image(payload: TryOnPayloadWithMultipleImages, request: Request,
+                                     encoding: OutputEncoding = Depends(output_encoding),
+                                     _admitted: None = Depends(admit_tryon_request)):
+    person_bytes, avatar = resolve_payload_person(payload)
+    product_bytes_list = decode_base64_images(payload.productImages, "productImages",
+                                              person_bytes if avatar is None else None)
+    return await tryon_response(request, person_bytes, product_bytes_list, payload, encoding, multi_image=True, avatar=avatar)
+
+@app.post("/generate_multi_image/upload", response_class=Response, responses=IMAGE_RESPONSE,
+          openapi_extra=multipart_openapi({"personImage": False, "productImages": True}))
+async def generate_tryon_multi_image_upload(request: Request, encoding: OutputEncoding = Depends(output_encoding),
+                                            _admitted: None = Depends(admit_tryon_request)):
+    details, files = await read_tryon_form(request, ["personImage", "productImages"])
     try:
-        # Decode the avatar image
-        person_image = Image.open(BytesIO(base64.b64decode(payload.personImage)))
+        person_bytes = files["personImage"][0].read_bytes() if files.get("personImage") else None
+        product_bytes_list = unique_images([upload.read_bytes() for upload in files["productImages"]])
+    finally:
+        close_uploads(files)
+    person_bytes, avatar = resolve_person(person_bytes, details.avatarId)
+    return await tryon_response(request, person_bytes, product_bytes_list, details, encoding, multi_image=True,
+                                avatar=avatar)
+
+class ProductBriefPayload(BaseModel):
+    productId: Optional[str] = Field(None, description="Your catalog id; try-on requests can then reference the brief by productId.")
+    productName: str = ""
+    productDesc: str
+    productImages: List[str] = Field(..., min_length=1, description="Base64 product images (front, back, details).")
+
+class ProductBriefResponse(BaseModel):
+    productId: Optional[str] = None
+    imageKey: str = Field(..., description="Content hash of the product images and description.")
+    brief: str
+    createdAt: float
+    cached: bool
+
+def product_brief_response(entry, cached: bool) -> ProductBriefResponse:
+    return ProductBriefResponse(productId=entry.product_id, imageKey=entry.image_key, brief=entry.brief,
+                                createdAt=entry.created_at, cached=cached)
+
+@app.post("/products/briefs", response_model=ProductBriefResponse)
+async def precompute_product_brief(payload: ProductBriefPayload, refresh: bool = False,
+                                   _admitted: None = Depends(admit_tryon_request)):
+    # ✅ Runs the product half of Step 1 once per catalog item, ahead of any shopper request.
+    current_priority.set("precompute")
+    product_bytes_list = decode_base64_images(payload.productImages, "productImages")
+    image_key = BriefCache.make_key(product_bytes_list, payload.productDesc, PRODUCT_BRIEF_VERSION)
+    existing = None if refresh else product_briefs.find(None, image_key)
+    if existing is not None:
+        if payload.productId and existing.product_id != payload.productId:
+            existing = product_briefs.put(payload.productId, image_key, existing.brief)
+        return product_brief_response(existing, cached=True)
+
+    try:
+        normalized = await normalize_images(product_bytes_list, normalize_settings)
+        brief = await describe_product([image.as_part() for image in normalized], payload.productName, payload.productDesc)
+    except Exception as e:
+        raise tryon_http_error(e)
+    prompt_log.info("Precomputed product brief for %s:\n%s", payload.productId or image_key[:12], brief)
+    return product_brief_response(product_briefs.put(payload.productId, image_key, brief), cached=False)
+
+@app.get("/products/briefs/{product_id}", response_model=ProductBriefResponse)
+async def get_product_brief(product_id: str):
+    entry = product_briefs.find(product_id, "")
+    if entry is None:
+        raise HTTPException(status_code=404, detail="No precomputed brief for this product.")
+    return product_brief_response(entry, cached=True)
+
+class AvatarPayload(BaseModel):
+    personImage: str
+
+class AvatarInfo(BaseModel):
+    avatarId: str
+    width: int
+    height: int
+    bytes: int = Field(..., description="Size of the stored, normalized image.")
+    analysisReady: bool = Field(..., description="False while the pose/lighting analysis is still running.")
+    createdAt: float
 
-        # Decode the list of product images
-        product_image_objects = [Image.open(BytesIO(base64.b64decode(img))) for img in payload.productImages]
+def avatar_info(avatar: Avatar) -> AvatarInfo:
+    return AvatarInfo(avatarId=avatar.id, width=avatar.image.size[0], height=avatar.image.size[1],
+                      bytes=len(avatar.image.data), analysisReady=avatar.analysis is not None, createdAt=avatar.created_at)
 
-        ai_generated_dynamic_prompt = ""
+# Background analyses by avatar id, so registering the same photo twice starts only one.
+avatar_analyses = {}
+
+async def analyze_registered_avatar(avatar: Avatar):
+    current_priority.set("precompute")
+    try:
+        avatar_store.set_analysis(avatar.id, await analyze_avatar(avatar.image.data, avatar.image.as_part()))
+    except Exception as e:
+        log.warning("Avatar analysis for %s failed; it will be retried on the next registration. Error: %s", avatar.id, e)
+    finally:
+        avatar_analyses.pop(avatar.id, None)
+
+async def register_avatar(person_bytes: bytes) -> Avatar:
+    avatar_id = AvatarStore.make_id(person_bytes)
+    avatar = avatar_store.get(avatar_id)
+    if avatar is None:
         try:
-            # The contents for the first AI call now include the avatar image
-            # followed by the list of product images
-            description_model_contents = [meta_prompt_multi_image, person_image] + product_image_objects
-            
-            description_response = description_model.generate_content(
-                description_model_contents,
-                generation_config={"temperature": 0.5}
-            )
-            ai_generated_dynamic_prompt = description_response.text.strip()
-            print("\n--- AI as Master Prompt Engineer Generated the Following (Multi-Image) ---")
-            print(ai_generated_dynamic_prompt)
-            print("-----------------------------------------------------------\n")
-            
+            image = (await normalize_images([person_bytes], normalize_settings))[0]
         except Exception as e:
-            print(f"WARNING: Dynamic prompt generation failed. Using basic fallback. Error: {e}")
-            ai_generated_dynamic_prompt = "## GOAL\nCreate an image of the avatar wearing the new clothing. Preserve the avatar's identity and the background."
-
-        # The wrapper prompt remains the same simple executor.
-        image_gen_prompt = f"""
+            raise tryon_http_error(e)
+        avatar = Avatar(avatar_id, image)
+        avatar_store.put(avatar)
+    if avatar.analysis is None and avatar.id not in avatar_analyses:
+        avatar_analyses[avatar.id] = asyncio.create_task(analyze_registered_avatar(avatar))
+    return avatar
+
+@app.post("/avatars", status_code=201, response_model=AvatarInfo)
+async def create_avatar(payload: AvatarPayload):
+    # ✅ Normalizes and stores the person image once; the analysis runs in the background.
+    return avatar_info(await register_avatar(decode_base64_image(payload.personImage, "personImage")))
+
+@app.post("/avatars/upload", status_code=201, response_model=AvatarInfo,
+          openapi_extra={"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+              "type": "object", "properties": {"personImage": {"type": "string", "format": "binary"}},
+              "required": ["personImage"]}}}}})
+async def create_avatar_upload(request: Request):
+    try:
+        _, files = await read_multipart_images(request, ["personImage"], upload_limits)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    try:
+        if not files.get("personImage"):
+            raise HTTPException(status_code=422, detail="Missing image field(s): personImage")
+        person_bytes = files["personImage"][0].read_bytes()
+    finally:
+        close_uploads(files)
+    return avatar_info(await register_avatar(person_bytes))
+
+@app.get("/avatars/{avatar_id}", response_model=AvatarInfo)
+async def get_avatar(avatar_id: str):
+    avatar = avatar_store.get(avatar_id)
+    if avatar is None:
+        raise HTTPException(status_code=404, detail="Avatar not found.")
+    return avatar_info(avatar)
+
+@app.delete("/avatars/{avatar_id}", status_code=204)
+async def delete_avatar(avatar_id: str):
+    if not avatar_store.delete(avatar_id):
+        raise HTTPException(status_code=404, detail="Avatar not found.")
+    return Response(status_code=204)
+
+# --- 5b. Try-on pipeline (shared by every try-on endpoint and the job workers) ---
+FALLBACK_PROMPT = "## GOAL\nCreate an image of the avatar wearing the new clothing. Preserve the avatar's identity and the background."
+
+class TryOnError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class TryOnResult:
+    def __init__(self, image: bytes, timer: StageTimer, brief_source: str):
+        self.image = image
+        self.timer = timer
+        self.brief_source = brief_source
+        self.result_id: Optional[str] = None
+
+    @property
+    def storable(self) -> bool:
+        # Like the brief cache, the result store never keeps what the fallback brief produced, nor a
+        # speculative win (fallback or bare product brief): replaying either would pin one slow or
+        # failed Step 1 onto every identical request, even once the model's brief is cached.
+        return self.brief_source != "fallback" and not self.brief_source.startswith("speculative")
+
+class BriefStream:
+    """Progress of a streamed Step-1 brief, updated from the model worker thread as chunks arrive."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        self.chars = 0
+
+    def add(self, chunk) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.started
+        try:
+            self.chars += len(chunk.text)
+        except ValueError:
+            pass  # a chunk without text parts, e.g. the final one carrying only the finish reason
+
+# Step-1 calls left running after a speculative win; they still fill the brief cache.
+background_briefs = set()
+
+def release_brief_task(task: asyncio.Task) -> None:
+    background_briefs.discard(task)
+    if not task.cancelled():
+        task.exception()  # a failure was either handled by the pipeline or is moot after a speculative win
+
+async def notify_stage(on_stage, stage: str, **data):
+    if on_stage is not None:
+        await on_stage(stage, data)
+
+async def run_tryon_pipeline(person_bytes: bytes, product_bytes_list: List[bytes], details: TryOnDetails,
+                             multi_image: bool = False, on_stage=None, avatar: Optional[Avatar] = None) -> TryOnResult:
+    """
+    Normalize -> Step 1 (brief) -> Step 2 (image). `on_stage(stage, data)` is awaited after
+    each stage ("decoded", "brief_ready", "image_ready") so callers can report progress.
+    Pass `avatar` when the person image is already normalized (registered avatars, batches);
+    a ready avatar analysis then replaces the avatar half of Step 1.
+    """
+    timer = StageTimer()
+    endpoint = "multi" if multi_image else "single"
+    PAYLOAD_BYTES.observe(len(person_bytes) + sum(len(img) for img in product_bytes_list), endpoint=endpoint, direction="in")
+    try:
+        return await _run_tryon_stages(person_bytes, product_bytes_list, details, multi_image, on_stage, timer, avatar)
+    finally:
+        for stage, seconds, _ in timer.stages:
+            STAGE_LATENCY.observe(seconds, endpoint=endpoint, stage=stage)
+
+async def _run_tryon_stages(person_bytes, product_bytes_list, details, multi_image, on_stage, timer,
+                            avatar=None) -> TryOnResult:
+    # Normalize the avatar and every product image once; both steps reuse the result
+    with timer.stage("decode") as span:
+        if avatar is None:
+            normalized = await normalize_images([person_bytes] + product_bytes_list, normalize_settings)
+        else:
+            normalized = [avatar.image] + await normalize_images(product_bytes_list, normalize_settings)
+        span.description = describe_savings(normalized)
+    person_image = normalized[0].as_part()
+    product_image_objects = [image.as_part() for image in normalized[1:]]
+    await notify_stage(on_stage, "decoded", images=len(normalized))
+
+    style_instructions = []
+    if details.tone: style_instructions.append(f"- Desired Tone: {details.tone}")
+    if details.style: style_instructions.append(f"- Rendering Style: {details.style}")
+
+    # =================================================================
+    # === STEP 1: AI AS A MASTER PROMPT ENGINEER ===
+    # =================================================================
+    ai_generated_dynamic_prompt = "" # Fallback
+    step1_started = time.perf_counter()
+    brief_source = "model"
+    brief_task = None  # set while a brief that missed the speculation budget is still being written
+    endpoint = "multi" if multi_image else "single"
+    try:
+        stored_brief = None
+        if details.briefMode != "full" or (avatar is not None and avatar.analysis):
+            stored_brief = await precomputed_brief(details, person_bytes, product_bytes_list, person_image,
+                                                   product_image_objects, avatar)
+        if multi_image:
+            # The multi-image meta-prompt does not use productDesc, so only the images go into the key.
+            brief_key = BriefCache.make_key([person_bytes] + product_bytes_list, "", META_PROMPT_MULTI_IMAGE_VERSION)
+        else:
+            brief_key = BriefCache.make_key([person_bytes] + product_bytes_list, details.productDesc, META_PROMPT_VERSION)
+        cached_brief = brief_cache.get(brief_key) if stored_brief is None else None
+        if stored_brief is not None:
+            ai_generated_dynamic_prompt, brief_source = stored_brief
+        elif cached_brief is not None:
+            ai_generated_dynamic_prompt = cached_brief
+            brief_source = "cache"
+            log.info("Reusing cached Shot Execution Brief")
+        else:
+            if multi_image:
+                # The avatar image is followed by the list of product images
+                template, task, temperature = MULTI_IMAGE_TEMPLATE, MULTI_IMAGE_TEMPLATE.task(), 0.5
+            else:
+                # meta_prompt = meta_prompt_1_production_ready
+                template, temperature = SHOT_BRIEF_TEMPLATE, 0.2 # Temp allows for creative descriptions of fabric physics
+                task = template.task(details.productDesc)
+                prompt_log.info("Product description: %s", details.productDesc)
+
+            contents = [task, person_image] + product_image_objects
+            if details.latencyMode == "fast" and SPECULATION_BUDGET > 0:
+                stream = BriefStream()
+                brief_task = asyncio.create_task(write_brief(template, contents, temperature, brief_key, stream))
+                background_briefs.add(brief_task)
+                brief_task.add_done_callback(release_brief_task)
+                done, _ = await asyncio.wait([brief_task], timeout=SPECULATION_BUDGET)
+                if done:
+                    brief_task = None
+                    ai_generated_dynamic_prompt = done.pop().result()
+                    SPECULATION.inc(endpoint=endpoint, outcome="brief_in_budget")
+                else:
+                    ai_generated_dynamic_prompt, brief_source = speculative_brief(details, product_bytes_list)
+                    log.info("Brief not ready after %.1fs (%d chars streamed); starting Step 2 on the %s brief",
+                             SPECULATION_BUDGET, stream.chars, brief_source)
+            else:
+                ai_generated_dynamic_prompt = await write_brief(template, contents, temperature, brief_key)
+
+    except (PoolSaturatedError, RateLimited):
+        raise
+    except Exception as e:
+        log.warning("Dynamic prompt generation failed. Using basic fallback. Error: %s", e)
+        ai_generated_dynamic_prompt = FALLBACK_PROMPT
+        brief_source = "fallback"
+    timer.record("brief", time.perf_counter() - step1_started, brief_source)
+    BRIEF_SOURCES.inc(endpoint=endpoint, source=brief_source)
+    await notify_stage(on_stage, "brief_ready", source=brief_source)
+    # =================================================================
+    # === END OF STEP 1 ===
+    # =================================================================
+
+    # =================================================================
+    # === STEP 2: IMAGE GENERATION (Executing the master prompt) ===
+    # =================================================================
+    if brief_task is None:
+        with timer.stage("generate"):
+            generated_image_data = await generate_image(ai_generated_dynamic_prompt, person_image, product_image_objects,
+                                                        multi_image)
+    else:
+        generated_image_data, brief_source = await speculative_step2(
+            brief_task, ai_generated_dynamic_prompt, brief_source, person_image, product_image_objects, multi_image, timer)
+
+    await notify_stage(on_stage, "image_ready", bytes=len(generated_image_data))
+    PAYLOAD_BYTES.observe(len(generated_image_data), endpoint=endpoint, direction="out")
+    log.info("Timings (ms): %s", timer.as_dict())
+    return TryOnResult(generated_image_data, timer, brief_source)
+
+async def write_brief(template: PromptTemplate, contents, temperature: float, brief_key: str,
+                      stream: Optional[BriefStream] = None) -> str:
+    # Call the description model to generate the entire new prompt. The template's static
+    # instructions come from Gemini's context cache when registered, else they are sent inline.
+    description_response = await description_calls.call(
+        prompt_cache.bind(description_model, template, on_chunk=stream.add if stream is not None else None),
+        contents,
+        generation_config={"temperature": temperature}
+    )
+    if stream is not None and stream.first_chunk is not None:
+        BRIEF_FIRST_CHUNK.observe(stream.first_chunk, template=template.name)
+    ai_generated_dynamic_prompt = description_response.text.strip()
+    brief_cache.put(brief_key, ai_generated_dynamic_prompt)
+    prompt_log.info("AI as Master Prompt Engineer generated the following brief:\n%s", ai_generated_dynamic_prompt)
+    return ai_generated_dynamic_prompt
+
+def speculative_brief(details: TryOnDetails, product_bytes_list: List[bytes]):
+    # The best brief available without waiting on a model: a stored product brief, else the generic fallback.
+    image_key = BriefCache.make_key(product_bytes_list, details.productDesc, PRODUCT_BRIEF_VERSION)
+    entry = product_briefs.find(details.productId, image_key)
+    if entry is not None:
+        return f"{PRECOMPUTED_BRIEF_DIRECTIVE}\n\n{entry.brief}", "speculative+precomputed"
+    return FALLBACK_PROMPT, "speculative"
+
+async def speculative_step2(brief_task, brief: str, brief_source: str, person_image, product_image_objects,
+                            multi_image: bool, timer: StageTimer):
+    """
+    Step 2 for a brief that missed the speculation budget: one image call starts now on the
+    speculative `brief`, a second one as soon as the model's brief arrives. The first image
+    back wins and the other call is cancelled; the Step-1 call is left to finish so its brief
+    is cached. Returns (image, brief_source of the winner).
+    """
+    endpoint = "multi" if multi_image else "single"
+    started = time.perf_counter()
+    speculative = asyncio.create_task(generate_image(brief, person_image, product_image_objects, multi_image))
+    candidates = {speculative: (brief_source, started)}
+    pending = {speculative, brief_task}
+    brief_ready_at, error = None, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Images first: a speculative image that is already back makes the regular call unnecessary.
+            for task in sorted(done, key=lambda task: task is brief_task):
+                if task is brief_task:
+                    brief_ready_at = time.perf_counter()
+                    try:
+                        model_brief = task.result()
+                    except Exception as e:
+                        log.warning("Dynamic prompt generation failed; keeping the speculative Step 2. Error: %s", e)
+                        continue
+                    regular = asyncio.create_task(generate_image(
+                        model_brief, person_image, product_image_objects, multi_image,
+                        on_call=lambda: SPECULATION_DUPLICATES.inc(endpoint=endpoint)))
+                    candidates[regular] = ("model", brief_ready_at)
+                    pending.add(regular)
+                    continue
+                try:
+                    image = task.result()
+                except Exception as e:
+                    error = e
+                    continue
+                source, task_started = candidates[task]
+                timer.record("generate", time.perf_counter() - task_started, source)
+                if task is speculative:
+                    # Without speculation, Step 2 would have started once the brief was ready.
+                    SPECULATION.inc(endpoint=endpoint, outcome="speculative_won")
+                    if brief_ready_at is not None:
+                        SPECULATION_SAVED.inc(brief_ready_at - started, endpoint=endpoint)
+                    else:
+                        brief_task.add_done_callback(
+                            lambda _: SPECULATION_SAVED.inc(time.perf_counter() - started, endpoint=endpoint))
+                else:
+                    SPECULATION.inc(endpoint=endpoint, outcome="brief_won")
+                return image, source
+        SPECULATION.inc(endpoint=endpoint, outcome="failed")
+        raise error
+    finally:
+        for task in pending:
+            if task is not brief_task:
+                task.cancel()
+
+async def generate_image(brief: str, person_image, product_image_objects, multi_image: bool,
+                         on_call: Optional[Callable[[], None]] = None) -> bytes:
+    # The wrapper prompt is now a simple executor.
+    image_gen_prompt = f"""
         You are a high-fidelity image synthesis engine. Your task is to execute the following technical instructions from an AI Specialist. Adhere to every rule with absolute precision.
 
-        {ai_generated_dynamic_prompt}
+        {brief}
+
         """
 
-        # The contents for the final image generation call also include all images
-        final_gen_contents = [image_gen_prompt, person_image] + product_image_objects
-        
-        generation_config = {
-            "temperature": 0.1,
-            "candidate_count": 1
-        }
-        
-        response = image_generation_model.generate_content(
-            final_gen_contents,
-            generation_config=generation_config
+    # The contents for the final image generation call also include all images
+    contents = [image_gen_prompt, person_image] + product_image_objects
+
+    # Low temperature for the final execution to ensure it follows the strict rules.
+    generation_config = {
+        "temperature": 0.1 if multi_image else 0.2,
+        "candidate_count": 1
+    }
+
+    generate_content = image_generation_model.generate_content
+    if on_call is not None:
+        # Called on the worker thread as each upstream call starts, not when the task is created.
+        def generate_content(*args, model=image_generation_model, **kwargs):
+            on_call()
+            return model.generate_content(*args, **kwargs)
+
+    response = await image_calls.call(
+        generate_content,
+        contents,
+        generation_config=generation_config
+    )
+
+    generated_image_data = None
+    for part in response.candidates[0].content.parts:
+        if part.inline_data:
+            generated_image_data = part.inline_data.data
+            break
+
+    if not generated_image_data:
+        block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
+        BLOCK_REASONS.inc(reason=str(block_reason))
+        raise TryOnError(500, f"Image generation failed. Reason: {block_reason}")
+    return generated_image_data
+
+PRECOMPUTED_BRIEF_DIRECTIVE = """## RENDER INTENT
+A high-fidelity, photorealistic replacement of the avatar's clothing with the product described in the PRODUCT BRIEF below.
+## INPAINTING & MASKING DIRECTIVE (IDENTITY PRESERVATION)
+The head, neck, and hands of the avatar are a protected "no-render zone" and MUST be preserved 1:1. Keep the avatar's pose, body proportions and the background unchanged, and light the garment to match the existing scene lighting."""
+
+async def precomputed_brief(details, person_bytes, product_bytes_list, person_image, product_image_objects,
+                            avatar: Optional[Avatar] = None):
+    """
+    Builds the Step-2 brief from a product brief plus, when there is one, an avatar analysis,
+    instead of the full Step-1 call. Returns (brief, source), or None to run the full Step 1.
+
+    The product brief comes from the catalog store; for a registered avatar with a ready
+    analysis it is written now from the product images alone and stored for next time.
+    The analysis is the registered avatar's, or for briefMode="avatar" a short cached one.
+    """
+    image_key = BriefCache.make_key(product_bytes_list, details.productDesc, PRODUCT_BRIEF_VERSION)
+    entry = product_briefs.find(details.productId, image_key)
+    analysis = avatar.analysis if avatar is not None else None
+    if entry is not None:
+        product_brief, source = entry.brief, "precomputed"
+    elif analysis:
+        try:
+            product_brief = await describe_product(product_image_objects, details.productName, details.productDesc)
+        except (PoolSaturatedError, RateLimited):
+            raise
+        except Exception as e:
+            log.warning("Product brief failed; running the full Step 1. Error: %s", e)
+            return None
+        product_briefs.put(details.productId, image_key, product_brief)
+        source = "product"
+    else:
+        log.info("No precomputed brief for product %s; running the full Step 1", details.productId or image_key[:12])
+        return None
+
+    if analysis is None and details.briefMode == "avatar":
+        try:
+            analysis = await analyze_avatar(person_bytes, person_image)
+        except (PoolSaturatedError, RateLimited):
+            raise
+        except Exception as e:
+            log.warning("Avatar analysis failed; using the product brief alone. Error: %s", e)
+    if analysis:
+        return f"{PRECOMPUTED_BRIEF_DIRECTIVE}\n\n{analysis}\n\n{product_brief}", f"{source}+avatar"
+    return f"{PRECOMPUTED_BRIEF_DIRECTIVE}\n\n{product_brief}", source
+
+async def describe_product(product_image_objects, product_name: str, product_desc: str) -> str:
+    response = await description_calls.call(
+        description_model.generate_content,
+        [meta_prompt_product_brief(product_name, product_desc)] + product_image_objects,
+        generation_config={"temperature": 0.2}
+    )
+    return response.text.strip()
+
+async def analyze_avatar(person_bytes: bytes, person_image) -> str:
+    # The avatar analysis only depends on the person image, so repeat shoppers hit the cache.
+    avatar_key = BriefCache.make_key([person_bytes], "", AVATAR_ANALYSIS_VERSION)
+    analysis = brief_cache.get(avatar_key)
+    if analysis is None:
+        response = await description_calls.call(
+            description_model.generate_content,
+            [meta_prompt_avatar_analysis, person_image],
+            generation_config={"temperature": 0.2}
         )
-        
-        generated_image_data = None
-        for part in response.candidates[0].content.parts:
-            if part.inline_data:
-                generated_image_data = part.inline_data.data
-                break
-                
-        if generated_image_data:
-            return Response(content=generated_image_data, media_type="image/png")
+        analysis = response.text.strip()
+        brief_cache.put(avatar_key, analysis)
+    return analysis
+
+def tryon_http_error(e: Exception) -> HTTPException:
+    # Maps a pipeline failure onto the status codes the endpoints have always returned.
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, PoolSaturatedError):
+        return saturated_exception(e)
+    if isinstance(e, RateLimited):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if isinstance(e, UpstreamTimeout):
+        return HTTPException(status_code=504, detail=f"Image generation timed out: {e}")
+    if is_retryable(e):
+        return HTTPException(status_code=502, detail=f"The image model failed after retries: {e}")
+    if isinstance(e, TryOnError):
+        return HTTPException(status_code=e.status_code, detail=e.detail)
+    if isinstance(e, ImageRejected):
+        return HTTPException(status_code=e.status_code, detail=e.detail)
+    if isinstance(e, Image.DecompressionBombError):
+        return HTTPException(status_code=413, detail=f"Image rejected: {e}")
+    if isinstance(e, UnidentifiedImageError):
+        return HTTPException(status_code=400, detail="Could not read image: unsupported or corrupt image data.")
+    return HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
+
+# ✅ Identical concurrent requests (double-clicked "Generate") share one upstream computation.
+tryon_flights = SingleFlight()
+
+def tryon_request_key(person_bytes: bytes, product_bytes_list: List[bytes], details: TryOnDetails, multi_image: bool) -> str:
+    # Fast-mode images may come from a speculative brief, so they get their own key and never stand in for quality ones.
+    fast = ("latency=fast",) if details.latencyMode == "fast" else ()
+    return request_key("multi" if multi_image else "single", [person_bytes] + product_bytes_list,
+                       details.productDesc, details.tone, details.style, details.productId, details.briefMode, *fast)
+
+async def run_and_store(key: str, person_bytes: bytes, product_bytes_list: List[bytes], details: TryOnDetails,
+                        multi_image: bool = False, on_stage=None, avatar: Optional[Avatar] = None) -> TryOnResult:
+    result = await run_tryon_pipeline(person_bytes, product_bytes_list, details, multi_image, on_stage, avatar)
+    if result_store is not None and result.storable:
+        try:
+            stored = await asyncio.to_thread(result_store.put, key, result.image, details.productName)
+            result.result_id = stored.digest
+        except OSError as e:
+            log.warning("Could not store the generated image: %s", e)
+    return result
+
+def result_headers(result_id: str) -> dict:
+    return {"ETag": f'"{result_id}"', "X-Result-Id": result_id, "X-Result-Url": f"/results/{result_id}"}
+
+async def encoded_result(image: bytes, result_id: Optional[str], encoding: OutputEncoding):
+    # (body or file path, media type, ETag): stored results keep their encoded variants on disk,
+    # unstored ones are encoded for this response only.
+    if encoding.is_original:
+        return image, "image/png", f'"{result_id}"'
+    etag = f'"{result_id}-{encoding.key}"'
+    if result_id is not None:
+        stored = await asyncio.to_thread(result_store.get, result_id)
+        if stored is not None:
+            return await stored_variant_path(stored, encoding), encoding.mime_type, etag
+    return await asyncio.to_thread(encode_output, image, encoding), encoding.mime_type, etag
+
+async def tryon_response(request: Request, person_bytes: bytes, product_bytes_list: List[bytes], details: TryOnDetails,
+                         encoding: OutputEncoding, multi_image: bool = False, avatar: Optional[Avatar] = None) -> Response:
+    key = tryon_request_key(person_bytes, product_bytes_list, details, multi_image)
+    # A request we have already rendered is answered from the result store; send
+    # "Cache-Control: no-cache" to force a fresh generation.
+    if result_store is not None and "no-cache" not in request.headers.get("cache-control", ""):
+        stored = await asyncio.to_thread(result_store.find, key)
+        if stored is not None:
+            path = await stored_variant_path(stored, encoding)
+            etag = f'"{stored.digest}"' if encoding.is_original else f'"{stored.digest}-{encoding.key}"'
+            return stored_file_response(request, path, etag, encoding.mime_type, vary=True,
+                                        extra_headers={**result_headers(stored.digest), "X-Result-Cache": "HIT"})
+    try:
+        result, shared = await tryon_flights.do(
+            key, lambda: run_and_store(key, person_bytes, product_bytes_list, details, multi_image, avatar=avatar)
+        )
+    except Exception as e:
+        raise tryon_http_error(e)
+    encode_started = time.perf_counter()
+    body, media_type, etag = await encoded_result(result.image, result.result_id, encoding)
+    # The result may be shared with coalesced requests, so this request's encode time is not added to its timer.
+    encode_timing = f'encode;dur={(time.perf_counter() - encode_started) * 1000:.1f};desc="{encoding.key}"'
+    headers = {"Server-Timing": f"{result.timer.header()}, {encode_timing}", "Vary": "Accept"}
+    if result.result_id:
+        headers.update(result_headers(result.result_id), ETag=etag)
+    if shared:
+        headers["X-Coalesced"] = "1"
+    if isinstance(body, bytes):
+        response = Response(content=body, media_type=media_type, headers=headers)
+    else:
+        response = FileResponse(body, media_type=media_type, headers=headers)
+    STAGE_LATENCY.observe(time.perf_counter() - encode_started, endpoint="multi" if multi_image else "single", stage="encode")
+    return response
+
+# --- 5c. Batch: one avatar, many products, results streamed as NDJSON ---
+# ✅ BATCH_MAX_PRODUCTS caps one request; BATCH_CONCURRENCY caps how many of its products run at once.
+BATCH_MAX_PRODUCTS = int(os.getenv("BATCH_MAX_PRODUCTS", "10"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+
+class BatchProduct(TryOnDetails):
+    productImage: Optional[str] = Field(None, description="Single product image.")
+    productImages: Optional[List[str]] = Field(None, description="Several product angles (multi-image brief).")
+
+class BatchPayload(BaseModel):
+    personImage: Optional[str] = Field(None, description="The person image, shared by every product in the batch.")
+    avatarId: Optional[str] = Field(None, description="A registered avatar, instead of personImage.")
+    products: List[BatchProduct] = Field(..., min_length=1)
+
+async def batch_item(index: int, product: BatchProduct, person_bytes: bytes, avatar: Avatar,
+                     use_store: bool, inline: bool) -> dict:
+    # One product's try-on; failures become an error line instead of failing the batch.
+    try:
+        multi_image = product.productImages is not None
+        if multi_image == (product.productImage is not None):
+            raise HTTPException(status_code=422, detail="Provide exactly one of productImage or productImages.")
+        if multi_image:
+            product_bytes_list = decode_base64_images(product.productImages, "productImages",
+                                                      person_bytes if avatar is None else None)
         else:
-            block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
-            raise HTTPException(status_code=500, detail=f"Image generation failed. Reason: {block_reason}")
+            product_bytes_list = [decode_base64_image(product.productImage, "productImage")]
+        details = TryOnDetails(**product.model_dump(include=set(TryOnDetails.model_fields)))
+        key = tryon_request_key(person_bytes, product_bytes_list, details, multi_image)
+
+        stored = await asyncio.to_thread(result_store.find, key) if use_store else None
+        if stored is not None:
+            line = {"index": index, "status": "succeeded", "cached": True, "resultId": stored.digest}
+            if inline:
+                with open(stored.path, "rb") as f:
+                    line["image"] = base64.b64encode(await asyncio.to_thread(f.read)).decode()
+        else:
+            result, shared = await tryon_flights.do(
+                key, lambda: run_and_store(key, person_bytes, product_bytes_list, details, multi_image, avatar=avatar)
+            )
+            line = {"index": index, "status": "succeeded", "cached": False, "resultId": result.result_id,
+                    "briefSource": result.brief_source, "timings": result.timer.as_dict()}
+            if inline or result.result_id is None:
+                line["image"] = base64.b64encode(result.image).decode()
+        if line["resultId"]:
+            line["resultUrl"] = f"/results/{line['resultId']}"
+        return line
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
+        return batch_error_line(index, e)
+
+def batch_error_line(index: int, e: Exception) -> dict:
+    error = tryon_http_error(e)
+    return {"index": index, "status": "failed", "error": {"status_code": error.status_code, "detail": error.detail}}
+
+@app.post("/generate/batch", responses={200: {"content": {"application/x-ndjson": {}},
+                                              "description": "One JSON line per product as it finishes, then a summary line."}})
+async def generate_tryon_batch(payload: BatchPayload, request: Request, inline: bool = False):
+    """
+    Tries N products on one avatar. The avatar is decoded and normalized once; products run
+    concurrently (at most BATCH_CONCURRENCY at a time, and the model pool still bounds the
+    upstream calls). Admission is per product and taken inside the stream, where the work
+    runs (a request-level dependency may be released before a streamed body starts); a
+    product refused admission gets a 429 line. Each line carries `index` into `products`; images are returned
+    as /results URLs, or inline as base64 with ?inline=true or when the result store is off.
+    """
+    if len(payload.products) > BATCH_MAX_PRODUCTS:
+        raise HTTPException(status_code=422, detail=f"At most {BATCH_MAX_PRODUCTS} products per batch.")
+    person_bytes, avatar = resolve_payload_person(payload)
+    if avatar is None:
+        try:
+            avatar = Avatar(None, (await normalize_images([person_bytes], normalize_settings))[0])
+        except Exception as e:
+            raise tryon_http_error(e)
+    use_store = result_store is not None and "no-cache" not in request.headers.get("cache-control", "")
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def limited(index, product):
+        current_priority.set("batch")
+        async with limit:
+            try:
+                async with model_pool.admit():
+                    return await batch_item(index, product, person_bytes, avatar, use_store, inline)
+            except PoolSaturatedError as e:
+                return batch_error_line(index, e)
+
+    async def stream():
+        tasks = [asyncio.create_task(limited(index, product)) for index, product in enumerate(payload.products)]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                succeeded += line["status"] == "succeeded"
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"done": True, "succeeded": succeeded, "failed": len(tasks) - succeeded}) + "\n"
+        finally:
+            # Client went away: stop products that have not started (in-flight calls finish in single-flight).
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# --- 5d. Job API: submit now, poll or stream progress, fetch the image later ---
+class JobPayload(TryOnDetails):
+    personImage: Optional[str] = None
+    productImage: Optional[str] = Field(None, description="Single product image (same as /generate).")
+    productImages: Optional[List[str]] = Field(None, description="Several product angles (same as /generate_multi_image).")
+
+class JobStatus(BaseModel):
+    id: str
+    status: str = Field(..., description="queued, running, succeeded or failed.")
+    stage: Optional[str] = Field(None, description="Last reached stage: started, decoded, brief_ready, image_ready, done.")
+    error: Optional[dict] = None
+    createdAt: float
+    updatedAt: float
+    resultUrl: Optional[str] = None
+    eventsUrl: str
+
+def job_error(e: Exception) -> dict:
+    error = tryon_http_error(e)
+    return {"status_code": error.status_code, "detail": error.detail}
+
+# ✅ JOB_STORE=memory|sqlite (JOB_DB_PATH), JOB_WORKERS, JOB_MAX_QUEUED, JOB_TTL
+job_runner = JobRunner.from_env(error_mapper=job_error)
+
+def job_status(job: JobRecord) -> JobStatus:
+    return JobStatus(
+        id=job.id, status=job.status, stage=job.stage, error=job.error,
+        createdAt=job.created_at, updatedAt=job.updated_at,
+        resultUrl=f"/jobs/{job.id}/result" if job.status == "succeeded" else None,
+        eventsUrl=f"/jobs/{job.id}/events",
+    )
+
+async def get_job_or_404(job_id: str) -> JobRecord:
+    job = await job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.post("/jobs", status_code=202, response_model=JobStatus)
+async def create_job(payload: JobPayload, response: Response):
+    if (payload.productImage is None) == (payload.productImages is None):
+        raise HTTPException(status_code=422, detail="Provide exactly one of productImage or productImages.")
+    multi_image = payload.productImages is not None
+    person_bytes, avatar = resolve_payload_person(payload)
+    if multi_image:
+        product_bytes_list = decode_base64_images(payload.productImages, "productImages",
+                                                  person_bytes if avatar is None else None)
+    else:
+        product_bytes_list = [decode_base64_image(payload.productImage, "productImage")]
+    # Keep only the decoded bytes and the text fields alive while the job waits in the queue
+    details = TryOnDetails(**payload.model_dump(include=set(TryOnDetails.model_fields)))
+
+    key = tryon_request_key(person_bytes, product_bytes_list, details, multi_image)
+    client = current_client.get()
+
+    async def handler(job_id, on_stage):
+        current_client.set(client)
+        result = await run_and_store(key, person_bytes, product_bytes_list, details, multi_image, on_stage, avatar)
+        return result.image, result.result_id
+
+    try:
+        job = await job_runner.submit(handler)
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Too many queued jobs. Please retry shortly.", headers={"Retry-After": "10"})
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return job_status(job)
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str):
+    return job_status(await get_job_or_404(job_id))
+
+@app.get("/jobs/{job_id}/result", response_class=Response, responses=IMAGE_RESPONSE)
+async def get_job_result(job_id: str, encoding: OutputEncoding = Depends(output_encoding)):
+    job = await get_job_or_404(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error["status_code"], detail=job.error["detail"])
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}; no result yet.", headers={"Retry-After": "2"})
+    # A stored result serves its cached variant from disk; otherwise the job's bytes are encoded per request.
+    image = await job_runner.get_result(job_id)
+    body, media_type, etag = await encoded_result(image, job.result_id, encoding)
+    headers = {"Vary": "Accept"}
+    if job.result_id:
+        headers.update(result_headers(job.result_id), ETag=etag)
+    if isinstance(body, bytes):
+        return Response(content=body, media_type=media_type, headers=headers)
+    return FileResponse(body, media_type=media_type, headers=headers)
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    # Server-Sent Events: one event per stage. Reconnecting clients resume via Last-Event-ID.
+    await get_job_or_404(job_id)
+    last_event_id = request.headers.get("last-event-id", "")
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    async def event_stream():
+        index = start
+        while True:
+            seen = job_runner.version  # read before the store, so nothing published after it is missed
+            job = await job_runner.get(job_id)
+            finished = job is None or job.done  # the in-memory record is live; decide before the events snapshot
+            for event in await job_runner.events(job_id, index):
+                yield f"id: {index}\nevent: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+                index += 1
+            if finished or await request.is_disconnected():
+                break
+            if not await job_runner.wait_for_change(seen, timeout=15):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 
@@ -446,8 +1543,7 @@ def meta_prompt_1_production_ready(description):
 
 
 # This is the "Lead Technical Artist" meta-prompt. It is a comprehensive training document designed to elevate the AI to a master of visual and data synthesis.
-def meta_prompt_test_for_better(description): 
-    return f"""
+meta_prompt_shot_brief_instructions = """
 **ROLE:** You are an AI Lead Technical Artist & VFX Supervisor. Your function is to generate a "Shot Execution Brief"—a master-level, technically flawless render instruction set for a subsequent, diffusion-based image synthesis engine. You do not create the final image; you write the unimpeachable technical blueprint that guarantees its perfection by synthesizing visual evidence with hard data.
 
 **YOUR PRIMARY DIRECTIVE:**
@@ -506,6 +1602,41 @@ Texture: Sample the fine, repeating white pinstripe pattern from the product ima
 Roughness: Sample the matte, high-microsurface roughness of wool suiting fabric.
 ---
 
-**YOUR TASK NOW:**
+"""
+
+def meta_prompt_shot_brief_task(description):
+    return f"""**YOUR TASK NOW:**
 Analyze the provided avatar image, the **collection** of product images, and critically, the provided **textual data** `{description}`. Generate a new, master-level Shot Execution Brief that follows the exact structure, technical language, and extraordinary level of detail demonstrated in the examples above. Your output must begin with `## RENDER INTENT`.
-"""
\ No newline at end of file
+"""
+
+def meta_prompt_test_for_better(description):
+    return meta_prompt_shot_brief_instructions + meta_prompt_shot_brief_task(description)
+
+# Step-1 templates: static instructions (cached upstream) + the per-request task.
+SHOT_BRIEF_TEMPLATE = PromptTemplate("shot_brief", META_PROMPT_VERSION, meta_prompt_shot_brief_instructions,
+                                     meta_prompt_shot_brief_task)
+MULTI_IMAGE_TEMPLATE = PromptTemplate("multi_image", META_PROMPT_MULTI_IMAGE_VERSION, meta_prompt_multi_image_instructions,
+                                      lambda: meta_prompt_multi_image_task)
+
+
+# Product-only half of the Step-1 analysis, run once per catalog item by POST /products/briefs.
+def meta_prompt_product_brief(name, description):
+    return f"""
+**ROLE:** You are an AI 3D Garment Specialist. You write the product section of a "Shot Execution Brief" for a diffusion-based image synthesis engine that will later dress an avatar you have not seen.
+
+**YOUR TASK:**
+1.  **SYNTHESIZE THE PRODUCT (MULTI-IMAGE ANALYSIS):** The images show the same garment from different angles. Identify the front view, the back view and any close-up detail shots of textures, seams or hardware.
+2.  **TEXTUAL DATA (GROUND TRUTH):** Product name: `{name}`. Details: `{description}`. Use this to verify and correct your visual analysis of material and fit.
+3.  **PBR MATERIALS:** Describe albedo, specular reflectivity, microsurface roughness, and any translucency or metallic hardware.
+4.  **FIT & CONSTRUCTION:** Describe how the stated fit should sit on a body (tension, drape, where it ends), and the seams and panels visible in the back view.
+
+Do not describe any person, pose or lighting. Your output must begin with `## PRODUCT BRIEF`.
+"""
+
+
+# Short avatar-only analysis used with briefMode="avatar"; combined with a precomputed product brief.
+meta_prompt_avatar_analysis = """
+**ROLE:** You are an AI VFX Supervisor preparing a clothing replacement on the avatar in this image.
+Describe, concisely: the pose and skeletal mechanics that will shape the fabric (bent arms, lean, weight shift); the lighting setup (key, fill and rim direction, softness, color temperature); the clothing currently worn that must be replaced; and surfaces where contact shadows will be needed.
+Do not describe the face beyond marking head, hair, neck and hands as the identity preservation mask. Your output must begin with `## AVATAR & SCENE ANALYSIS`.
+"""
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from imaging import NormalizedImage
+
+
+class Avatar:
+    """A normalized person image plus its cached pose/lighting analysis (None until it is ready)."""
+
+    def __init__(self, id: Optional[str], image: NormalizedImage, analysis: Optional[str] = None,
+                 created_at: Optional[float] = None):
+        self.id = id
+        self.image = image
+        self.analysis = analysis
+        self.created_at = created_at or time.time()
+
+
+class AvatarStore:
+    """
+    Registered avatars, keyed by a hash of the uploaded photo so registering the same photo
+    twice returns the same id. Kept in an LRU bounded by the total size of the normalized
+    images (`max_bytes`), backed by SQLite when `db_path` is set (otherwise avatars evicted
+    from memory have to be registered again).
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, db_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Avatar]" = OrderedDict()
+        self._db = None
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS avatars (id TEXT PRIMARY KEY, data BLOB NOT NULL, mime_type TEXT NOT NULL,"
+                    " width INTEGER, height INTEGER, original_bytes INTEGER, original_width INTEGER,"
+                    " original_height INTEGER, analysis TEXT, created_at REAL NOT NULL)"
+                )
+
+    @classmethod
+    def from_env(cls) -> "AvatarStore":
+        return cls(
+            max_bytes=int(os.getenv("AVATAR_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            db_path=os.getenv("AVATAR_DB") or None,
+        )
+
+    @staticmethod
+    def make_id(photo: bytes) -> str:
+        return hashlib.sha256(photo).hexdigest()[:32]
+
+    def get(self, avatar_id: str) -> Optional[Avatar]:
+        with self._lock:
+            avatar = self._entries.get(avatar_id)
+            if avatar is not None:
+                self._entries.move_to_end(avatar_id)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT data, mime_type, width, height, original_bytes, original_width, original_height, analysis,"
+                    " created_at FROM avatars WHERE id = ?", (avatar_id,)
+                ).fetchone()
+                if row is not None:
+                    image = NormalizedImage(row[0], row[1], (row[2], row[3]), row[4], (row[5], row[6]))
+                    avatar = Avatar(avatar_id, image, row[7], row[8])
+                    self._remember(avatar)
+            self.counters["hits" if avatar is not None else "misses"] += 1
+            return avatar
+
+    def put(self, avatar: Avatar) -> None:
+        image = avatar.image
+        with self._lock:
+            self._remember(avatar)
+            self.counters["stores"] += 1
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO avatars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (avatar.id, image.data, image.mime_type, image.size[0], image.size[1], image.original_bytes,
+                         image.original_size[0], image.original_size[1], avatar.analysis, avatar.created_at),
+                    )
+
+    def set_analysis(self, avatar_id: str, analysis: str) -> None:
+        with self._lock:
+            avatar = self._entries.get(avatar_id)
+            if avatar is not None:
+                avatar.analysis = analysis
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("UPDATE avatars SET analysis = ? WHERE id = ?", (analysis, avatar_id))
+
+    def delete(self, avatar_id: str) -> bool:
+        with self._lock:
+            removed = self._entries.pop(avatar_id, None)
+            found = removed is not None
+            if removed is not None:
+                self.total_bytes -= len(removed.image.data)
+            if self._db is not None:
+                with self._db:
+                    found = self._db.execute("DELETE FROM avatars WHERE id = ?", (avatar_id,)).rowcount > 0 or found
+            return found
+
+    def _remember(self, avatar: Avatar) -> None:
+        previous = self._entries.pop(avatar.id, None)
+        if previous is not None:
+            self.total_bytes -= len(previous.image.data)
+        self._entries[avatar.id] = avatar
+        self.total_bytes += len(avatar.image.data)
+        # The newest avatar always stays, even if it alone exceeds max_bytes.
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted.image.data)
+            self.counters["evictions"] += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,100 @@
+"""
+Load-test harness for the try-on endpoints, using a local fake model instead of Gemini.
+
+Fires many concurrent /generate requests at the app in-process and, while they run,
+keeps probing a cheap endpoint to show the event loop stays responsive.
+
+    python benchmarks/load_test.py --requests 40 --latency 0.5
+    MODEL_MAX_CONCURRENCY=4 MODEL_MAX_QUEUE=8 python benchmarks/load_test.py --requests 40
+"""
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+from collections import Counter
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRYON_BACKEND", "fake")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("RESULT_DIR", "")  # measure generation, not the result store
+
+import httpx
+from PIL import Image
+
+import app as tryon
+from fake_backend import FakeModel
+
+
+def make_image_b64(size=(256, 256), color=(200, 120, 80)) -> str:
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+async def probe_loop(client: httpx.AsyncClient, stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get("/openapi.json")
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+
+
+async def main(args):
+    image_b64 = make_image_b64()
+    description = FakeModel("text", latency=args.latency)
+    image = FakeModel("image", latency=args.latency, output_bytes=64 * 1024)
+    tryon.set_model_clients(description, image)
+
+    payload = {
+        "personImage": image_b64,
+        "productImage": image_b64,
+        "productName": "Load Test Tee",
+        "productSize": "M",
+        "productDesc": "100% cotton, regular fit",
+    }
+
+    transport = httpx.ASGITransport(app=tryon.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        stop = asyncio.Event()
+        probe_samples = []
+        probe = asyncio.create_task(probe_loop(client, stop, probe_samples))
+
+        async def one(i):
+            start = time.perf_counter()
+            body = payload if args.identical else {**payload, "productDesc": f"{payload['productDesc']} #{i}"}
+            response = await client.post("/generate", json=body)
+            return response.status_code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(args.requests)))
+        wall = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    statuses = Counter(status for status, _ in results)
+    ok_latencies = sorted(latency for status, latency in results if status == 200)
+    calls = description.calls + image.calls
+    serial_estimate = calls * args.latency
+
+    print(f"requests           : {args.requests}")
+    print(f"status codes       : {dict(statuses)}")
+    print(f"pool               : {tryon.model_pool.stats()}")
+    print(f"single-flight      : {tryon.tryon_flights.stats()}")
+    print(f"brief cache        : {tryon.brief_cache.stats()}")
+    print(f"upstream calls     : {calls} (peak in flight: description {description.peak_in_flight}, image {image.peak_in_flight})")
+    print(f"wall time          : {wall:.2f}s (serial would be ~{serial_estimate:.2f}s)")
+    if ok_latencies:
+        print(f"200 latency        : min {ok_latencies[0]:.2f}s  max {ok_latencies[-1]:.2f}s")
+    if probe_samples:
+        print(f"probe latency      : max {max(probe_samples) * 1000:.1f}ms over {len(probe_samples)} probes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds each fake model call blocks for.")
+    parser.add_argument("--identical", action="store_true", help="Send the same payload every time (exercises single-flight).")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,152 @@
+"""
+Cold-start benchmark: for each endpoint, starts a fresh interpreter, times `import app`,
+then the first and second request to that endpoint, and lists which heavy libraries
+were loaded by then. Requests are driven straight through ASGI, so the harness itself
+imports nothing the app might defer.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --warmup          # run the warm-up hook before the first request
+    python benchmarks/startup.py --backend gemini  # real clients (needs GEMINI_API_KEY for /generate)
+
+The fake backend (TRYON_BACKEND=fake) never loads the Gemini SDK; use --backend gemini with
+--scenarios metrics proxy_image to see the import cost without calling the API.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("metrics", "proxy_image", "generate", "generate_multi_image")
+HEAVY_MODULES = ("google.generativeai", "google.api_core", "httpx", "PIL", "uvicorn")
+
+
+async def asgi_request(app, method: str, path: str, query: str = "", body: bytes = b"") -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"bench"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 5000), "server": ("bench", 80),
+    }
+    received = False
+    status = None
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait()  # the client never disconnects
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+def child(args) -> None:
+    # Runs in the fresh interpreter; prints one JSON line for the parent.
+    sys.path.insert(0, ROOT)
+    with open(args.payloads) as f:
+        payloads = json.load(f)
+    started = time.perf_counter()
+    import app as tryon
+    result = {"import_ms": (time.perf_counter() - started) * 1000,
+              "loaded_at_import": [m for m in HEAVY_MODULES if m in sys.modules]}
+
+    if args.scenario == "metrics":
+        request = ("GET", "/metrics", "", b"")
+    elif args.scenario == "proxy_image":
+        request = ("GET", "/proxy-image", f"url={args.image_url}/product.jpg", b"")
+    else:
+        request = ("POST", "/" + args.scenario, "", json.dumps(payloads[args.scenario]).encode())
+
+    async def run():
+        if args.warmup:
+            started = time.perf_counter()
+            await tryon.warm_up()
+            result["warmup_ms"] = (time.perf_counter() - started) * 1000
+        for label in ("first", "second"):
+            started = time.perf_counter()
+            result[f"{label}_status"] = await asgi_request(tryon.app, *request)
+            result[f"{label}_ms"] = (time.perf_counter() - started) * 1000
+        await tryon.image_proxy.close()
+
+    asyncio.run(run())
+    result["loaded_after_first"] = [m for m in HEAVY_MODULES if m in sys.modules]
+    print(json.dumps(result))
+
+
+def main(args) -> int:
+    from suite import ImageServer, make_jpeg  # only the parent needs Pillow and the image server
+
+    person, product = make_jpeg(1200, 1600, 1), make_jpeg(1000, 1000, 2)
+    details = {"productName": "Bench Tee", "productSize": "M", "productDesc": "100% cotton, regular fit"}
+    payloads = {
+        "generate": {**details, "personImage": base64.b64encode(person).decode(),
+                     "productImage": base64.b64encode(product).decode()},
+        "generate_multi_image": {**details, "personImage": base64.b64encode(person).decode(),
+                                 "productImages": [base64.b64encode(product).decode()] * 3},
+    }
+    image_server = ImageServer(make_jpeg(800, 800, 3))
+    env = {**os.environ, "TRYON_BACKEND": args.backend, "RESULT_DIR": "", "LOG_LEVEL": "WARNING",
+           "FAKE_DESCRIPTION_LATENCY": str(args.description_latency), "FAKE_IMAGE_LATENCY": str(args.image_latency)}
+    if args.backend == "gemini":
+        env.setdefault("GEMINI_API_KEY", "startup-benchmark")
+    results = []
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(payloads, f)
+    try:
+        print(f"{'scenario':<22}{'process ms':>11}{'import ms':>10}{'warmup ms':>10}{'first ms':>10}{'second ms':>10}"
+              f"{'status':>8}  loaded after first request")
+        for scenario in args.scenarios:
+            command = [sys.executable, os.path.abspath(__file__), "--child", "--scenario", scenario,
+                       "--payloads", f.name, "--image-url", image_server.url] + (["--warmup"] if args.warmup else [])
+            started = time.perf_counter()
+            output = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(f"{scenario:<22} failed:\n{output.stderr}")
+                continue
+            result = {"scenario": scenario, "process_ms": (time.perf_counter() - started) * 1000,
+                      **json.loads(output.stdout.strip().splitlines()[-1])}
+            results.append(result)
+            warmup = f"{result['warmup_ms']:.0f}" if "warmup_ms" in result else "-"
+            print(f"{scenario:<22}{result['process_ms']:>11.0f}{result['import_ms']:>10.0f}{warmup:>10}"
+                  f"{result['first_ms']:>10.0f}{result['second_ms']:>10.0f}{result['first_status']:>8}"
+                  f"  {', '.join(result['loaded_after_first'])}")
+    finally:
+        os.unlink(f.name)
+        image_server.close()
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"settings": {k: v for k, v in vars(args).items() if k != "json"}, "results": results},
+                      out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--backend", choices=("fake", "gemini"), default="fake")
+    parser.add_argument("--warmup", action="store_true", help="Call the app's warm-up hook before the first request.")
+    parser.add_argument("--description-latency", type=float, default=0.2)
+    parser.add_argument("--image-latency", type=float, default=0.5)
+    parser.add_argument("--json", help="Write results to this file.")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--payloads", help=argparse.SUPPRESS)
+    parser.add_argument("--image-url", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+    if parsed.child:
+        child(parsed)
+        sys.exit(0)
+    sys.exit(main(parsed))
@@ -0,0 +1,249 @@
+"""
+Offline benchmark suite: runs the real app under uvicorn with the fake Gemini backend
+(TRYON_BACKEND=fake) and a local image server, then drives /generate,
+/generate_multi_image and /proxy-image at several concurrency levels.
+
+Reports throughput, p50/p95/p99 latency, errors and the server's peak RSS. Every scenario and
+concurrency level gets a fresh server process, so its peak RSS is its own. Save a run with
+--json and compare a later run against it with --baseline to catch regressions:
+
+    python benchmarks/suite.py --json before.json
+    python benchmarks/suite.py --baseline before.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("generate", "generate_multi_image", "proxy_image")
+
+
+def make_jpeg(width: int, height: int, seed: int) -> bytes:
+    noise = hashlib.shake_256(str(seed).encode()).digest(width * height * 3)
+    buffer = BytesIO()
+    Image.frombytes("RGB", (width, height), noise).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class ImageServer:
+    """Serves one JPEG under any path, with an ETag and short max-age, like a retailer CDN."""
+
+    def __init__(self, image: bytes):
+        etag = '"%s"' % hashlib.sha256(image).hexdigest()[:16]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(image)))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "max-age=60")
+                self.end_headers()
+                self.wfile.write(image)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def start_app(port: int, args) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "TRYON_BACKEND": "fake",
+        "FAKE_DESCRIPTION_LATENCY": str(args.description_latency),
+        "FAKE_IMAGE_LATENCY": str(args.image_latency),
+        "FAKE_LATENCY_JITTER": str(args.jitter),
+        "FAKE_FAILURE_RATE": str(args.failure_rate),
+        "FAKE_SLOW_RATE": str(args.slow_rate),
+        "FAKE_SLOW_LATENCY": str(args.slow_latency),
+        "FAKE_OUTPUT_BYTES": str(args.output_bytes),
+        "LOG_LEVEL": "WARNING",
+        "MODEL_MAX_CONCURRENCY": str(max(args.concurrency)),
+        "MODEL_MAX_QUEUE": str(max(args.concurrency) * 4),
+    }
+    if not args.allow_cache:
+        # The result store would answer repeated payloads from disk.
+        env["RESULT_DIR"] = ""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    for _ in range(200):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return server
+        except httpx.TransportError:
+            if server.poll() is not None:
+                raise RuntimeError("app server exited during startup")
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("app server did not start")
+
+
+def peak_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_request(scenario: str, i: int, images: dict, image_server_url: str, unique: bool):
+    details = {"productName": "Bench Tee", "productSize": "M",
+               "productDesc": f"100% cotton, regular fit #{i if unique else 0}"}
+    if scenario == "generate":
+        return "POST", "/generate", {"json": {**details, "personImage": images["person"], "productImage": images["product"]}}
+    if scenario == "generate_multi_image":
+        return "POST", "/generate_multi_image", {"json": {**details, "personImage": images["person"],
+                                                          "productImages": [images["product"]] * 3}}
+    # Cycle through a fixed set of URLs so the proxy sees a realistic mix of misses and repeats.
+    return "GET", "/proxy-image", {"params": {"url": f"{image_server_url}/products/{i % 20}.jpg"}}
+
+
+async def run_scenario(base_url: str, scenario: str, concurrency: int, requests: int, images: dict,
+                       image_server_url: str, unique: bool) -> dict:
+    latencies, statuses = [], {}
+    counter = iter(range(requests))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            for i in counter:
+                method, path, kwargs = build_request(scenario, i, images, image_server_url, unique)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = "error"
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "ok": len(latencies),
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+        label = f"{result['scenario']} @ c={result['concurrency']}"
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {before['throughput_rps']:.2f} -> {result['throughput_rps']:.2f} rps")
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']:.0f} -> {result['p95_ms']:.0f} ms")
+        if before.get("peak_rss_mb") and result.get("peak_rss_mb") and result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{label}: peak RSS {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+async def main(args) -> int:
+    images = {
+        "person": base64.b64encode(make_jpeg(1200, 1600, 1)).decode(),
+        "product": base64.b64encode(make_jpeg(1000, 1000, 2)).decode(),
+    }
+    image_server = ImageServer(make_jpeg(800, 800, 3))
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = []
+    try:
+        print(f"{'scenario':<22}{'conc':>5}{'ok':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak MB':>9}  statuses")
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # VmHWM is a lifetime high-water mark, so each run gets its own server process.
+                server = start_app(args.port, args)
+                try:
+                    requests = max(args.requests, concurrency)
+                    result = await run_scenario(base_url, scenario, concurrency, requests, images, image_server.url,
+                                                not args.allow_cache)
+                    result["peak_rss_mb"] = peak_rss_mb(server.pid)
+                finally:
+                    server.terminate()
+                    server.wait()
+                results.append(result)
+                peak = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] else "n/a"
+                print(f"{scenario:<22}{concurrency:>5}{result['ok']:>6}{result['throughput_rps']:>9.2f}"
+                      f"{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}{result['p99_ms']:>9.0f}{peak:>9}  {result['statuses']}")
+    finally:
+        image_server.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+                       "results": results}, f, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="Requests per scenario and concurrency level.")
+    parser.add_argument("--description-latency", type=float, default=0.2)
+    parser.add_argument("--image-latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of model calls that take --slow-latency.")
+    parser.add_argument("--slow-latency", type=float, default=10.0)
+    parser.add_argument("--output-bytes", type=int, default=512 * 1024)
+    parser.add_argument("--allow-cache", action="store_true", help="Repeat identical payloads (exercises caches and single-flight).")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--json", help="Write results to this file.")
+    parser.add_argument("--baseline", help="Compare against a previous --json file; exit 1 on regression.")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,109 @@
+"""
+Peak-RSS benchmark: base64-in-JSON (/generate) vs streamed multipart (/generate/upload).
+
+Each mode runs against its own uvicorn server process (with the fake model from
+fake_backend.py) so the server's peak RSS (VmHWM, Linux only) can be compared cleanly.
+
+    python benchmarks/upload_memory.py --megapixels 12 --requests 5
+"""
+import argparse
+import base64
+import os
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def serve(port: int):
+    os.environ.update(TRYON_BACKEND="fake", FAKE_DESCRIPTION_LATENCY="0.01", FAKE_IMAGE_LATENCY="0.01",
+                      FAKE_OUTPUT_BYTES="1024", LOG_LEVEL="WARNING", RESULT_DIR="")
+    import uvicorn
+    import app as tryon
+
+    uvicorn.run(tryon.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def peak_rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    raise RuntimeError("VmHWM not available")
+
+
+def make_photo(megapixels: float) -> bytes:
+    from PIL import Image
+
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    # Random noise compresses badly, like a real high-detail photo.
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def wait_until_up(base_url: str):
+    for _ in range(100):
+        try:
+            httpx.get(f"{base_url}/brief-cache/stats", timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def run_mode(mode: str, photo: bytes, requests: int, port: int) -> dict:
+    server = subprocess.Popen([sys.executable, __file__, "--serve", str(port)], stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    details = {"productName": "Bench", "productSize": "M", "productDesc": "benchmark garment"}
+    try:
+        wait_until_up(base_url)
+        baseline = peak_rss_kb(server.pid)
+        encoded = base64.b64encode(photo).decode() if mode == "json" else None
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            for i in range(requests):
+                # Vary the description so the brief cache never short-circuits a request.
+                fields = {**details, "productDesc": f"benchmark garment {i}"}
+                if mode == "json":
+                    response = client.post("/generate", json={**fields, "personImage": encoded, "productImage": encoded})
+                else:
+                    response = client.post("/generate/upload", data=fields, files={
+                        "personImage": ("person.jpg", photo, "image/jpeg"),
+                        "productImage": ("product.jpg", photo, "image/jpeg"),
+                    })
+                response.raise_for_status()
+        return {"baseline_kb": baseline, "peak_kb": peak_rss_kb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, default=12)
+    parser.add_argument("--requests", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    photo = make_photo(args.megapixels)
+    print(f"image: {args.megapixels} MP JPEG, {len(photo) / 1e6:.1f} MB (x2 per request)")
+    for offset, mode in enumerate(("json", "multipart")):
+        result = run_mode(mode, photo, args.requests, args.port + offset)
+        growth = (result["peak_kb"] - result["baseline_kb"]) / 1024
+        print(f"{mode:<10} peak RSS {result['peak_kb'] / 1024:7.1f} MB  (+{growth:.1f} MB over idle server)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+
+class BriefCache:
+    """
+    Content-addressed cache for Step-1 "Shot Execution Briefs".
+
+    Two tiers:
+    - an in-process LRU bounded by `max_entries`, and
+    - an optional SQLite file (`db_path`) that survives restarts and is shared by workers.
+
+    Entries older than `ttl_seconds` are treated as missing in both tiers.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 24 * 3600, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS briefs (key TEXT PRIMARY KEY, brief TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> "BriefCache":
+        return cls(
+            max_entries=int(os.getenv("BRIEF_CACHE_SIZE", "512")),
+            ttl_seconds=float(os.getenv("BRIEF_CACHE_TTL", str(24 * 3600))),
+            db_path=os.getenv("BRIEF_CACHE_DB") or None,
+        )
+
+    @staticmethod
+    def make_key(images: Iterable[bytes], product_desc: str, prompt_version: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(prompt_version.encode())
+        for image_bytes in images:
+            # Hash each image separately so (a+b, c) never collides with (a, b+c).
+            digest.update(b"\0img")
+            digest.update(hashlib.sha256(image_bytes).digest())
+        digest.update(b"\0desc")
+        digest.update((product_desc or "").encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, brief = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return brief
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT brief, created_at FROM briefs WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    self._remember(key, row[1], row[0])
+                    self.counters["disk_hits"] += 1
+                    return row[0]
+
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key: str, brief: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, brief)
+            self.counters["stores"] += 1
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO briefs (key, brief, created_at) VALUES (?, ?, ?)", (key, brief, now))
+                self._db.execute("DELETE FROM briefs WHERE created_at < ?", (now - self.ttl_seconds,))
+                self._db.commit()
+
+    def _remember(self, key: str, created_at: float, brief: str) -> None:
+        self._entries[key] = (created_at, brief)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return {
+                **self.counters,
+                "entries": len(self._entries),
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "disk_tier": self._db is not None,
+            }
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+
+class FakeUpstreamError(ConnectionError):
+    """Raised by FakeModel to simulate a failed upstream call; retryable, like a 503 or dropped connection."""
+
+
+def make_png(size_bytes: int, seed: int) -> bytes:
+    """A valid PNG of roughly `size_bytes`, filled with deterministic noise so it does not compress."""
+    width = 256
+    height = max(1, size_bytes // (width * 3))
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+class FakeStream:
+    """A `stream=True` response: the same attributes, plus iteration yielding the text in a few timed chunks."""
+
+    def __init__(self, response, duration: float, chunks: int = 4):
+        self.__dict__.update(vars(response))
+        self._duration = duration
+        self._chunks = chunks
+
+    def __iter__(self):
+        size = max(1, -(-len(self.text) // self._chunks))
+        for start in range(0, len(self.text), size):
+            time.sleep(self._duration / self._chunks)
+            yield SimpleNamespace(text=self.text[start:start + size])
+
+
+class FakeModel:
+    """
+    Offline stand-in for genai.GenerativeModel with configurable latency, failure rate and
+    output size. It is deterministic for a given seed, so benchmark runs are comparable.
+
+    Text models answer with a short brief; image models answer with an inline PNG.
+    `slow_rate` of the calls take `slow_latency` instead, to exercise timeouts and hedging.
+    With stream=True the first chunk arrives after a quarter of the latency, the rest over the remainder.
+    """
+
+    def __init__(self, kind: str = "image", latency: float = 1.0, jitter: float = 0.0, failure_rate: float = 0.0,
+                 output_bytes: int = 512 * 1024, seed: int = 0, slow_rate: float = 0.0, slow_latency: float = 30.0):
+        self.kind = kind
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.image = make_png(output_bytes, seed) if kind == "image" else b""
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            if self._rng.random() < self.slow_rate:
+                delay = self.slow_latency
+            fail = self._rng.random() < self.failure_rate
+        first_chunk = delay / 4 if stream else delay
+        try:
+            time.sleep(first_chunk)
+            if fail:
+                with self._lock:
+                    self.failures += 1
+                raise FakeUpstreamError("Injected upstream failure (503)")
+            response = self._response(contents)
+            return FakeStream(response, delay - first_chunk) if stream else response
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _response(self, contents):
+        prompt_tokens = sum(len(part) // 4 if isinstance(part, str) else 258 for part in contents)
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=0, total_token_count=prompt_tokens)
+        if self.kind == "text":
+            digest = hashlib.sha256(repr([part for part in contents if isinstance(part, str)]).encode()).hexdigest()[:12]
+            text = f"## RENDER INTENT\nFake Shot Execution Brief {digest}."
+            usage.candidates_token_count = len(text) // 4
+            return SimpleNamespace(text=text, candidates=[], prompt_feedback=None, usage_metadata=usage)
+        part = SimpleNamespace(text=None, inline_data=SimpleNamespace(mime_type="image/png", data=self.image))
+        return SimpleNamespace(
+            text="",
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))],
+            prompt_feedback=None,
+            usage_metadata=usage,
+        )
+
+
+def fake_models_from_env():
+    """
+    Builds (description_model, image_model) from FAKE_* environment variables:
+    FAKE_DESCRIPTION_LATENCY, FAKE_IMAGE_LATENCY, FAKE_LATENCY_JITTER, FAKE_FAILURE_RATE,
+    FAKE_SLOW_RATE, FAKE_SLOW_LATENCY, FAKE_OUTPUT_BYTES, FAKE_SEED.
+    """
+    jitter = float(os.getenv("FAKE_LATENCY_JITTER", "0"))
+    failure_rate = float(os.getenv("FAKE_FAILURE_RATE", "0"))
+    slow = {"slow_rate": float(os.getenv("FAKE_SLOW_RATE", "0")), "slow_latency": float(os.getenv("FAKE_SLOW_LATENCY", "30"))}
+    seed = int(os.getenv("FAKE_SEED", "0"))
+    description = FakeModel("text", float(os.getenv("FAKE_DESCRIPTION_LATENCY", "1.0")), jitter, failure_rate, seed=seed, **slow)
+    image = FakeModel("image", float(os.getenv("FAKE_IMAGE_LATENCY", "4.0")), jitter, failure_rate,
+                      output_bytes=int(os.getenv("FAKE_OUTPUT_BYTES", str(512 * 1024))), seed=seed + 1, **slow)
+    return description, image
@@ -0,0 +1,222 @@
+import importlib.util
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+if TYPE_CHECKING:
+    import httpx
+
+BROWSER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+    "Referer": "https://www.google.com/"
+}
+
+
+class ProxyError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class CachedImage:
+    def __init__(self, content: bytes, content_type: str, etag: Optional[str], last_modified: Optional[str], max_age: float):
+        self.content = content
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.max_age = max_age
+        self.fetched_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.fetched_at < self.max_age
+
+    def has_validators(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+
+class ImageCache:
+    """URL-keyed LRU cache of proxied images, bounded by the total size of the cached bodies."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self.counters = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+
+    def get(self, url: str) -> Optional[CachedImage]:
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def put(self, url: str, entry: CachedImage) -> None:
+        if len(entry.content) > self.max_bytes:
+            return
+        self.discard(url)
+        self._entries[url] = entry
+        self.total_bytes += len(entry.content)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted.content)
+            self.counters["evictions"] += 1
+
+    def discard(self, url: str) -> None:
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.total_bytes -= len(entry.content)
+
+    def stats(self) -> dict:
+        return {**self.counters, "entries": len(self._entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+
+class ProxiedImage:
+    """
+    What /proxy-image sends back: either a cached body, or an upstream body that is
+    streamed through (and copied into the cache once it completes within the size cap).
+    """
+
+    def __init__(self, content_type: str, cache_status: str, content: Optional[bytes] = None,
+                 stream: Optional[AsyncIterator[bytes]] = None, content_length: Optional[str] = None,
+                 cache_control: Optional[str] = None):
+        self.content_type = content_type
+        self.cache_status = cache_status
+        self.content = content
+        self.stream = stream
+        self.content_length = content_length
+        # The upstream Cache-Control when it forbids caching, to pass on instead of our own max-age.
+        self.cache_control = cache_control
+
+
+def _max_age(cache_control: str, default: float) -> Optional[float]:
+    # Returns None when the upstream forbids caching.
+    directives = cache_control.lower()
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    match = re.search(r"max-age=(\d+)", directives)
+    return float(match.group(1)) if match else default
+
+
+class ImageProxy:
+    """
+    Fetches retailer images for the frontend through one shared, keep-alive httpx client
+    (HTTP/2 when the `h2` package is installed), with a hard byte cap and an LRU cache
+    that revalidates stale entries with ETag / Last-Modified.
+    """
+
+    def __init__(self, max_bytes: int, cache_max_bytes: int, default_ttl: float, timeout: float = 15.0):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self.cache = ImageCache(cache_max_bytes)
+        self._client: Optional["httpx.AsyncClient"] = None
+
+    @classmethod
+    def from_env(cls) -> "ImageProxy":
+        return cls(
+            max_bytes=int(os.getenv("PROXY_MAX_BYTES", str(15 * 1024 * 1024))),
+            cache_max_bytes=int(os.getenv("PROXY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            default_ttl=float(os.getenv("PROXY_CACHE_TTL", "600")),
+        )
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        # Created (and httpx imported) on first use, so cold starts that never proxy an image skip both.
+        if self._client is None or self._client.is_closed:
+            import httpx
+            self._client = httpx.AsyncClient(
+                headers=BROWSER_HEADERS,
+                follow_redirects=True,
+                timeout=self.timeout,
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch(self, url: str) -> ProxiedImage:
+        import httpx
+
+        cached = self.cache.get(url)
+        if cached is not None and cached.is_fresh():
+            self.cache.counters["hits"] += 1
+            return ProxiedImage(cached.content_type, "HIT", content=cached.content)
+
+        headers = {}
+        if cached is not None and cached.has_validators():
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        try:
+            request = self.client.build_request("GET", url, headers=headers)
+            response = await self.client.send(request, stream=True)
+        except httpx.RequestError as e:
+            raise ProxyError(400, f"Failed to fetch image: {e}")
+
+        if response.status_code == 304 and cached is not None:
+            await response.aclose()
+            cached.fetched_at = time.monotonic()
+            cache_control = response.headers.get("cache-control", "")
+            max_age = _max_age(cache_control, self.default_ttl)
+            self.cache.counters["revalidated"] += 1
+            if max_age is None:
+                self.cache.discard(url)
+                return ProxiedImage(cached.content_type, "REVALIDATED", content=cached.content, cache_control=cache_control)
+            cached.max_age = max_age
+            return ProxiedImage(cached.content_type, "REVALIDATED", content=cached.content)
+
+        try:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                raise ProxyError(400, "URL is not a direct image link.")
+            declared = response.headers.get("content-length")
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise ProxyError(413, f"Image is larger than {self.max_bytes} bytes.")
+        except httpx.HTTPStatusError as e:
+            await response.aclose()
+            raise ProxyError(e.response.status_code, f"Image server error: {e.response.status_code}")
+        except ProxyError:
+            await response.aclose()
+            raise
+
+        self.cache.counters["misses"] += 1
+        self.cache.discard(url)
+        # aiter_bytes() yields the decoded body, so a compressed upstream's Content-Length does not apply to it.
+        content_length = None if response.headers.get("content-encoding") else response.headers.get("content-length")
+        cache_control = response.headers.get("cache-control", "")
+        return ProxiedImage(content_type, "MISS", stream=self._stream_body(url, response, content_type),
+                            content_length=content_length,
+                            cache_control=cache_control if _max_age(cache_control, self.default_ttl) is None else None)
+
+    async def _stream_body(self, url: str, response: "httpx.Response", content_type: str) -> AsyncIterator[bytes]:
+        chunks = []
+        received = 0
+        try:
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > self.max_bytes:
+                    # Headers are already sent, so the only way to stop is to abort the response.
+                    raise ProxyError(413, f"Image is larger than {self.max_bytes} bytes.")
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await response.aclose()
+
+        max_age = _max_age(response.headers.get("cache-control", ""), self.default_ttl)
+        if max_age is not None:
+            self.cache.put(url, CachedImage(
+                b"".join(chunks), content_type,
+                response.headers.get("etag"), response.headers.get("last-modified"), max_age,
+            ))
@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional
+
+from PIL import Image, ImageOps, features
+
+FORMAT_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+OUTPUT_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+# Formats accepted as input (the same set the multipart reader sniffs for); MPO is how Pillow reports many phone JPEGs.
+INPUT_FORMATS = ("JPEG", "MPO", "PNG", "WEBP", "GIF")
+
+
+class ImageRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class NormalizeSettings:
+    """
+    `max_pixels` is checked against the header before any pixel is decoded: larger JPEGs are
+    decoded at a reduced DCT scale if that brings them under it, anything else is rejected.
+    Decoding runs on a pool of `decode_workers` threads shared by all requests, which also
+    bounds how many full-size bitmaps are in memory at once.
+    """
+
+    def __init__(self, max_edge: int = 1536, output_format: str = "JPEG", quality: int = 90,
+                 max_pixels: int = 40_000_000, decode_workers: Optional[int] = None):
+        self.max_edge = max_edge
+        self.output_format = output_format.upper()
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.decode_workers = decode_workers or min(4, os.cpu_count() or 1)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        if self.output_format not in FORMAT_MIME_TYPES:
+            raise ValueError(f"Unsupported IMAGE_FORMAT {output_format!r}; use one of {', '.join(FORMAT_MIME_TYPES)}")
+
+    @classmethod
+    def from_env(cls) -> "NormalizeSettings":
+        return cls(
+            max_edge=int(os.getenv("IMAGE_MAX_EDGE", "1536")),
+            output_format=os.getenv("IMAGE_FORMAT", "JPEG"),
+            quality=int(os.getenv("IMAGE_QUALITY", "90")),
+            max_pixels=int(os.getenv("IMAGE_MAX_PIXELS", "40000000")),
+            decode_workers=int(os.getenv("IMAGE_DECODE_WORKERS", "0")) or None,
+        )
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="decode")
+        return self._pool
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class NormalizedImage:
+    """An upright, size-capped, re-encoded image, ready to be sent to the model as-is."""
+
+    def __init__(self, data: bytes, mime_type: str, size: tuple, original_bytes: int, original_size: tuple):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+
+    def as_part(self) -> dict:
+        # Passing a blob (instead of a PIL image) stops the SDK from re-encoding
+        # the image as lossless WebP on every generate_content call.
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def probe_image(image: Image.Image, settings: NormalizeSettings) -> None:
+    """Checks format and dimensions from the header alone; Image.open has not decoded any pixels yet."""
+    if image.format not in INPUT_FORMATS:
+        raise ImageRejected(415, f"Unsupported image format {image.format}; send JPEG, PNG, WebP or GIF.")
+    width, height = image.size
+    if width * height <= settings.max_pixels:
+        return
+    if image.format in ("JPEG", "MPO"):
+        image.draft("RGB", (settings.max_edge, settings.max_edge))
+        if image.size[0] * image.size[1] <= settings.max_pixels:
+            return
+    raise ImageRejected(413, f"Image is {width}x{height} pixels; at most {settings.max_pixels / 1e6:g} megapixels are accepted.")
+
+
+def normalize_image(data: bytes, settings: NormalizeSettings) -> NormalizedImage:
+    image = Image.open(BytesIO(data))
+    original_size = image.size
+    original_format = image.format
+    probe_image(image, settings)
+
+    if image.format in ("JPEG", "MPO"):
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when the photo is much larger
+        # than we need. The result stays >= max_edge, so the final resize below still applies.
+        image.draft("RGB", (settings.max_edge, settings.max_edge))
+
+    exif_orientation = image.getexif().get(0x0112, 1)
+    image = ImageOps.exif_transpose(image)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha and settings.output_format == "JPEG":
+        # Product cut-outs are usually transparent PNGs; flatten them onto white.
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    if max(image.size) > settings.max_edge:
+        image.thumbnail((settings.max_edge, settings.max_edge), Image.LANCZOS)
+
+    buffer = BytesIO()
+    if settings.output_format == "PNG":
+        image.save(buffer, format="PNG")
+    else:
+        image.save(buffer, format=settings.output_format, quality=settings.quality)
+    encoded, output_format = buffer.getvalue(), settings.output_format
+
+    # Small, upright originals in a format the model accepts are often smaller than
+    # their re-encoding; keep the original bytes in that case.
+    untouched = image.size == original_size and exif_orientation == 1
+    if untouched and original_format in FORMAT_MIME_TYPES and len(data) <= len(encoded):
+        encoded, output_format = data, original_format
+
+    return NormalizedImage(
+        data=encoded,
+        mime_type=FORMAT_MIME_TYPES[output_format],
+        size=image.size,
+        original_bytes=len(data),
+        original_size=original_size,
+    )
+
+
+async def normalize_images(images: List[bytes], settings: NormalizeSettings) -> List[NormalizedImage]:
+    # Pillow releases the GIL while decoding/encoding, so the images are processed in parallel threads.
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(settings.pool, normalize_image, data, settings) for data in images))
+
+
+def unique_images(images: List[bytes]) -> List[bytes]:
+    """Drops byte-identical repeats (the same product photo sent twice), keeping the first occurrence's order."""
+    seen, unique = set(), []
+    for data in images:
+        digest = hashlib.sha256(data).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(data)
+    return unique
+
+
+def describe_savings(images: List[NormalizedImage]) -> str:
+    before = sum(image.original_bytes for image in images)
+    after = sum(len(image.data) for image in images)
+    return f"{before / 1024:.0f}KB->{after / 1024:.0f}KB"
+
+
+class OutputEncoding:
+    """How a generated image is sent back: the model's PNG as-is, or re-encoded (and maybe downscaled)."""
+
+    def __init__(self, format: str = "png", quality: int = 80, max_edge: Optional[int] = None):
+        self.format = format
+        self.quality = quality
+        self.max_edge = max_edge
+
+    @property
+    def is_original(self) -> bool:
+        return self.format == "png" and self.max_edge is None
+
+    @property
+    def mime_type(self) -> str:
+        return OUTPUT_MIME_TYPES[self.format]
+
+    @property
+    def key(self) -> str:
+        # Names the variant in caches, file names and ETags, e.g. "webp-q80-e1024".
+        key = self.format if self.format == "png" else f"{self.format}-q{self.quality}"
+        return f"{key}-e{self.max_edge}" if self.max_edge else key
+
+
+class OutputSettings:
+    """
+    Server side of output negotiation. `formats` is the preference order used when the
+    client's Accept header allows several; AVIF is dropped if Pillow was built without it.
+    """
+
+    def __init__(self, formats: List[str] = ("webp", "avif", "jpeg"), quality: int = 80):
+        unknown = [f for f in formats if f not in OUTPUT_MIME_TYPES]
+        if unknown:
+            raise ValueError(f"Unsupported OUTPUT_FORMATS {unknown!r}; use any of {', '.join(OUTPUT_MIME_TYPES)}")
+        self.available = [f for f in OUTPUT_MIME_TYPES if f != "avif" or features.check("avif")]
+        self.formats = [f for f in formats if f in self.available]
+        self.quality = quality
+
+    @classmethod
+    def from_env(cls) -> "OutputSettings":
+        return cls(
+            formats=[f.strip().lower() for f in os.getenv("OUTPUT_FORMATS", "webp,avif,jpeg").split(",") if f.strip()],
+            quality=int(os.getenv("OUTPUT_QUALITY", "80")),
+        )
+
+    def negotiate(self, accept: str, format: Optional[str] = None, quality: Optional[int] = None,
+                  max_edge: Optional[int] = None) -> OutputEncoding:
+        """
+        An explicit `format` wins; otherwise the first preferred format the Accept header names
+        explicitly. A bare */* (what fetch() sends) keeps the original PNG.
+        """
+        if format is None:
+            accepted = set()
+            for item in accept.split(","):
+                media_type, *params = [part.strip().lower() for part in item.split(";")]
+                weight = next((p[2:] for p in params if p.startswith("q=")), "1")
+                try:
+                    if float(weight) > 0:
+                        accepted.add(media_type)
+                except ValueError:
+                    accepted.add(media_type)
+            format = next((f for f in self.formats if OUTPUT_MIME_TYPES[f] in accepted), "png")
+        elif format not in self.available:
+            raise ValueError(f"This server cannot encode {format}.")
+        return OutputEncoding(format, quality or self.quality, max_edge)
+
+
+def encode_output(data: bytes, encoding: OutputEncoding) -> bytes:
+    """Re-encodes a generated image; blocking, so call it off the event loop."""
+    if encoding.is_original:
+        return data
+    with Image.open(BytesIO(data)) as image:
+        image.load()
+        if encoding.max_edge and max(image.size) > encoding.max_edge:
+            image.thumbnail((encoding.max_edge, encoding.max_edge), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if encoding.format == "jpeg" or not has_alpha:
+            image = image.convert("RGB")
+        elif image.mode != "RGBA":
+            image = image.convert("RGBA")
+        buffer = BytesIO()
+        if encoding.format == "png":
+            image.save(buffer, format="PNG", optimize=True)
+        elif encoding.format == "jpeg":
+            image.save(buffer, format="JPEG", quality=encoding.quality, optimize=True, progressive=True)
+        else:
+            image.save(buffer, format=encoding.format.upper(), quality=encoding.quality)
+    return buffer.getvalue()
@@ -0,0 +1,343 @@
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobRecord:
+    def __init__(self, id: str, status: str, stage: Optional[str], error: Optional[dict],
+                 created_at: float, updated_at: float, has_result: bool = False, result_id: Optional[str] = None):
+        self.id = id
+        self.status = status
+        self.stage = stage
+        self.error = error
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.has_result = has_result
+        self.result_id = result_id  # the result store's id, when the image was stored there
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+
+class JobStore(abc.ABC):
+    """
+    Where job status, stage events and results live. Stores that do I/O set `blocking`, and
+    JobRunner then calls them on a worker thread; the others are called on the event loop.
+    """
+
+    blocking = False
+
+    @abc.abstractmethod
+    def create(self, job_id: str) -> JobRecord:
+        ...
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        ...
+
+    @abc.abstractmethod
+    def update(self, job_id: str, status: str, stage: Optional[str] = None, error: Optional[dict] = None) -> None:
+        ...
+
+    @abc.abstractmethod
+    def add_event(self, job_id: str, event: dict) -> None:
+        ...
+
+    @abc.abstractmethod
+    def events(self, job_id: str, after: int = 0) -> List[dict]:
+        ...
+
+    @abc.abstractmethod
+    def set_result(self, job_id: str, image: bytes, result_id: Optional[str] = None) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def prune(self, older_than: float) -> None:
+        ...
+
+
+class InMemoryJobStore(JobStore):
+    def __init__(self):
+        self._jobs: Dict[str, JobRecord] = {}
+        self._events: Dict[str, List[dict]] = {}
+        self._results: Dict[str, bytes] = {}
+
+    def create(self, job_id: str) -> JobRecord:
+        now = time.time()
+        record = JobRecord(job_id, "queued", None, None, now, now)
+        self._jobs[job_id] = record
+        self._events[job_id] = []
+        return record
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        return self._jobs.get(job_id)
+
+    def update(self, job_id: str, status: str, stage: Optional[str] = None, error: Optional[dict] = None) -> None:
+        record = self._jobs[job_id]
+        record.status = status
+        record.stage = stage or record.stage
+        record.error = error
+        record.updated_at = time.time()
+
+    def add_event(self, job_id: str, event: dict) -> None:
+        self._events[job_id].append(event)
+
+    def events(self, job_id: str, after: int = 0) -> List[dict]:
+        return self._events.get(job_id, [])[after:]
+
+    def set_result(self, job_id: str, image: bytes, result_id: Optional[str] = None) -> None:
+        self._results[job_id] = image
+        self._jobs[job_id].has_result = True
+        self._jobs[job_id].result_id = result_id
+
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        return self._results.get(job_id)
+
+    def prune(self, older_than: float) -> None:
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done and job.updated_at < older_than]:
+            del self._jobs[job_id]
+            self._events.pop(job_id, None)
+            self._results.pop(job_id, None)
+
+
+class SqliteJobStore(JobStore):
+    """Durable job store. Jobs that were queued or running when the process died are marked failed on startup."""
+
+    blocking = True  # every write is a committed transaction, and results are multi-MB BLOBs
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL, result BLOB, result_id TEXT)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            if "result_id" not in columns:  # databases created before results were linked to the result store
+                self._db.execute("ALTER TABLE jobs ADD COLUMN result_id TEXT")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS job_events (job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL,"
+                " PRIMARY KEY (job_id, seq))"
+            )
+            interrupted = json.dumps({"status_code": 503, "detail": "Job was interrupted by a server restart."})
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE status IN ('queued', 'running')",
+                (interrupted, time.time()),
+            )
+
+    def create(self, job_id: str) -> JobRecord:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, created_at, updated_at) VALUES (?, 'queued', ?, ?)", (job_id, now, now)
+            )
+        return JobRecord(job_id, "queued", None, None, now, now)
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, stage, error, created_at, updated_at, result IS NOT NULL, result_id"
+                " FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return JobRecord(row[0], row[1], row[2], json.loads(row[3]) if row[3] else None, row[4], row[5], bool(row[6]),
+                         row[7])
+
+    def update(self, job_id: str, status: str, stage: Optional[str] = None, error: Optional[dict] = None) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, stage = COALESCE(?, stage), error = ?, updated_at = ? WHERE id = ?",
+                (status, stage, json.dumps(error) if error else None, time.time(), job_id),
+            )
+
+    def add_event(self, job_id: str, event: dict) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO job_events (job_id, seq, event)"
+                " VALUES (?, (SELECT COUNT(*) FROM job_events WHERE job_id = ?), ?)",
+                (job_id, job_id, json.dumps(event)),
+            )
+
+    def events(self, job_id: str, after: int = 0) -> List[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event FROM job_events WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def set_result(self, job_id: str, image: bytes, result_id: Optional[str] = None) -> None:
+        with self._lock, self._db:
+            self._db.execute("UPDATE jobs SET result = ?, result_id = ? WHERE id = ?", (image, result_id, job_id))
+
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def prune(self, older_than: float) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM job_events WHERE job_id IN"
+                " (SELECT id FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?)", (older_than,)
+            )
+            self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?", (older_than,)
+            )
+
+
+def job_store_from_env() -> JobStore:
+    kind = os.getenv("JOB_STORE", "memory").lower()
+    if kind == "sqlite":
+        return SqliteJobStore(os.getenv("JOB_DB_PATH", "jobs.sqlite3"))
+    if kind == "memory":
+        return InMemoryJobStore()
+    raise RuntimeError(f"Unknown JOB_STORE {kind!r}; use 'memory' or 'sqlite'")
+
+
+class QueueFull(Exception):
+    pass
+
+
+# (job_id, on_stage) -> (result image bytes, result store id or None)
+JobHandler = Callable[[str, Callable[[str, dict], Awaitable[None]]], Awaitable[Tuple[bytes, Optional[str]]]]
+
+
+class JobRunner:
+    """
+    Runs queued try-on jobs on a fixed number of asyncio worker tasks and records their
+    progress in a JobStore. Workers are started on first use, so the runner also works
+    when the ASGI server never sends lifespan events.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 4, max_queued: int = 100, ttl_seconds: float = 3600,
+                 error_mapper: Callable[[Exception], dict] = None):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self.error_mapper = error_mapper or (lambda e: {"status_code": 500, "detail": str(e)})
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._changed: Optional[asyncio.Condition] = None
+        self._version = 0  # bumped on every published event, so readers can tell whether they missed one
+
+    @classmethod
+    def from_env(cls, error_mapper=None) -> "JobRunner":
+        return cls(
+            job_store_from_env(),
+            workers=int(os.getenv("JOB_WORKERS", "4")),
+            max_queued=int(os.getenv("JOB_MAX_QUEUED", "100")),
+            ttl_seconds=float(os.getenv("JOB_TTL", "3600")),
+            error_mapper=error_mapper,
+        )
+
+    def _ensure_started(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._changed = asyncio.Condition()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def _call(self, method: Callable[..., Any], *args: Any) -> Any:
+        if self.store.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, job_id: str) -> Optional[JobRecord]:
+        return await self._call(self.store.get, job_id)
+
+    async def events(self, job_id: str, after: int = 0) -> List[dict]:
+        return await self._call(self.store.events, job_id, after)
+
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        return await self._call(self.store.get_result, job_id)
+
+    async def submit(self, handler: JobHandler) -> JobRecord:
+        self._ensure_started()
+        if self._queue.qsize() >= self.max_queued:
+            raise QueueFull()
+        await self._call(self.store.prune, time.time() - self.ttl_seconds)
+        job = await self._call(self.store.create, uuid.uuid4().hex)
+        self._queue.put_nowait((job.id, handler))
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, handler = await self._queue.get()
+            try:
+                await self._run(job_id, handler)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str, handler: JobHandler) -> None:
+        async def on_stage(stage: str, data: dict) -> None:
+            await self._call(self.store.update, job_id, "running", stage)
+            await self._publish(job_id, {"stage": stage, **data, "at": time.time()})
+
+        await self._call(self.store.update, job_id, "running", "started")
+        await self._publish(job_id, {"stage": "started", "at": time.time()})
+        try:
+            image, result_id = await handler(job_id, on_stage)
+        except Exception as e:
+            error = self.error_mapper(e)
+            await self._call(self.store.update, job_id, "failed", None, error)
+            await self._publish(job_id, {"stage": "failed", "error": error, "at": time.time()})
+            return
+        await self._call(self.store.set_result, job_id, image, result_id)
+        await self._call(self.store.update, job_id, "succeeded", "done")
+        await self._publish(job_id, {"stage": "done", "at": time.time()})
+
+    async def _publish(self, job_id: str, event: dict) -> None:
+        await self._call(self.store.add_event, job_id, event)
+        async with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    async def wait_for_change(self, seen: int, timeout: float) -> bool:
+        """
+        Blocks until an event is published after `seen`, a `version` read before the caller last
+        looked at the store; an event published in between returns at once instead of being missed.
+        Event-stream readers block here; the timeout also covers changes made by other processes.
+        """
+        self._ensure_started()
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self._version != seen), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len([task for task in self._tasks if not task.done()]),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queued": self.max_queued,
+        }
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
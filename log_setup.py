@@ -0,0 +1,29 @@
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """
+    Routes the app's loggers through a QueueHandler, so request handlers only enqueue
+    records and a background thread does the actual (blocking) stderr writes.
+
+    - LOG_LEVEL controls the `tryon` logger (default INFO).
+    - PROMPT_LOG_LEVEL controls `tryon.prompts`, which logs full prompts and briefs at
+      INFO. It defaults to WARNING, so prompts are only logged when explicitly enabled.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+
+    app_logger = logging.getLogger("tryon")
+    app_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    app_logger.handlers = [logging.handlers.QueueHandler(records)]
+    app_logger.propagate = False
+    logging.getLogger("tryon.prompts").setLevel(os.getenv("PROMPT_LOG_LEVEL", "WARNING").upper())
+
+    listener.start()
+    return listener
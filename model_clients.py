@@ -0,0 +1,48 @@
+import threading
+import time
+from typing import Any, Optional
+
+_configure_lock = threading.Lock()
+_configured_key: Optional[str] = None
+
+
+def _configure(api_key: str) -> None:
+    global _configured_key
+    with _configure_lock:
+        if _configured_key != api_key:
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+
+
+class LazyModel:
+    """
+    A genai.GenerativeModel that is only built on first use. Importing google.generativeai
+    and configuring it take most of a cold start, and endpoints such as /proxy-image never
+    need a model. Safe to use from several worker threads at once: one builds, the rest wait.
+    """
+
+    def __init__(self, model_name: str, api_key: str):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.load_seconds: Optional[float] = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> Any:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    import google.generativeai as genai
+                    _configure(self.api_key)
+                    self._model = genai.GenerativeModel(model_name=self.model_name)
+                    self.load_seconds = time.perf_counter() - started
+        return self._model
+
+    def generate_content(self, *args: Any, **kwargs: Any) -> Any:
+        return self.load().generate_content(*args, **kwargs)
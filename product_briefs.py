@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+
+class ProductBrief:
+    def __init__(self, brief: str, product_id: Optional[str], image_key: str, created_at: float):
+        self.brief = brief
+        self.product_id = product_id
+        self.image_key = image_key
+        self.created_at = created_at
+
+
+class ProductBriefStore:
+    """
+    Precomputed product-side briefs (material, fit, construction), computed once per catalog
+    item and reused for every shopper.
+
+    Each brief is reachable by its product id (when one was given) and by a hash of the
+    product images and description, so requests without a product id still find it.
+    Entries live in memory, or in SQLite when `db_path` is set.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, ProductBrief] = {}
+        self._db = None
+        self.counters = {"hits": 0, "misses": 0, "stores": 0}
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS product_briefs (key TEXT PRIMARY KEY, brief TEXT NOT NULL,"
+                    " product_id TEXT, image_key TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+
+    @classmethod
+    def from_env(cls) -> "ProductBriefStore":
+        return cls(os.getenv("PRODUCT_BRIEF_DB") or None)
+
+    @staticmethod
+    def id_key(product_id: str) -> str:
+        return f"id:{product_id}"
+
+    @staticmethod
+    def image_key_for(image_key: str) -> str:
+        return f"img:{image_key}"
+
+    def find(self, product_id: Optional[str], image_key: str) -> Optional[ProductBrief]:
+        keys = ([self.id_key(product_id)] if product_id else []) + [self.image_key_for(image_key)]
+        entry = self._lookup(keys)
+        self.counters["hits" if entry is not None else "misses"] += 1
+        return entry
+
+    def _lookup(self, keys: Iterable[str]) -> Optional[ProductBrief]:
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    return self._entries[key]
+                if self._db is not None:
+                    row = self._db.execute(
+                        "SELECT brief, product_id, image_key, created_at FROM product_briefs WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None:
+                        entry = ProductBrief(*row)
+                        self._entries[key] = entry
+                        return entry
+        return None
+
+    def put(self, product_id: Optional[str], image_key: str, brief: str) -> ProductBrief:
+        entry = ProductBrief(brief, product_id, image_key, time.time())
+        keys = ([self.id_key(product_id)] if product_id else []) + [self.image_key_for(image_key)]
+        with self._lock:
+            for key in keys:
+                self._entries[key] = entry
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO product_briefs (key, brief, product_id, image_key, created_at)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        [(key, brief, product_id, image_key, entry.created_at) for key in keys],
+                    )
+            self.counters["stores"] += 1
+        return entry
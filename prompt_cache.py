@@ -0,0 +1,200 @@
+import datetime
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from model_clients import LazyModel
+
+log = logging.getLogger("tryon.prompt_cache")
+
+# Errors meaning a registered cache is gone (expired or deleted elsewhere); looked up, not
+# imported, for the same cold-start reason as in resilience.py.
+STALE_CACHE_ERRORS = ("NotFound", "FailedPrecondition", "PermissionDenied")
+
+
+class PromptTemplate:
+    """
+    A meta-prompt split into its static `instructions` (role, process, gold-standard examples)
+    and a short `task` rendered per request. `version` goes into cache names and brief-cache
+    keys, so edit it whenever the text changes.
+    """
+
+    def __init__(self, name: str, version: str, instructions: str, task: Callable[..., str]):
+        self.name = name
+        self.version = version
+        self.instructions = instructions
+        self.task = task
+        self.display_name = f"tryon-{version}-{hashlib.sha256(instructions.encode()).hexdigest()[:12]}"
+
+
+class _Registration:
+    def __init__(self, model: Any, expires_at: float):
+        self.model = model
+        self.expires_at = expires_at
+
+
+class PromptCache:
+    """
+    Registers each template's instructions once as Gemini cached content, so a request only
+    sends its task text and images; the instructions are billed at the cached-token rate.
+
+    `bind(model, template)` returns a generate_content-like callable that takes the
+    per-request contents. It uses the cached model when the model is a Gemini LazyModel and
+    registration worked, and otherwise (fake or swapped-in models, caching disabled, content
+    below the model's cache minimum, API errors) sends the instructions inline as before.
+    Caches are reused across processes by display name and re-registered shortly before they
+    expire. With `on_chunk`, the call is streamed and every chunk is passed to it as it arrives;
+    the fully read response is still what gets returned. Blocking; the bound callables are
+    meant to run on the model worker pool.
+    """
+
+    def __init__(self, enabled: bool = True, ttl: float = 3600.0, retry_after: float = 300.0):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.retry_after = retry_after
+        # _lock guards the counters and the registry and is never held across a network call;
+        # _register_lock serializes the (network-bound) registrations themselves.
+        self._lock = threading.Lock()
+        self._register_lock = threading.Lock()
+        self._registrations: Dict[str, _Registration] = {}
+        self._failed_until: Dict[str, float] = {}
+        self.counters: Dict[tuple, float] = {}
+        self.events = {"registrations": 0, "reused": 0, "registration_failures": 0, "invalidations": 0}
+
+    @classmethod
+    def from_env(cls) -> "PromptCache":
+        return cls(
+            enabled=os.getenv("PROMPT_CACHE", "1").lower() in ("1", "true", "yes"),
+            ttl=float(os.getenv("PROMPT_CACHE_TTL", "3600")),
+        )
+
+    def bind(self, model: Any, template: PromptTemplate,
+             on_chunk: Optional[Callable[[Any], None]] = None) -> Callable[..., Any]:
+        def call(target: Any, contents: List[Any], kwargs: Dict[str, Any]) -> Any:
+            if on_chunk is None:
+                return target.generate_content(contents, **kwargs)
+            response = target.generate_content(contents, stream=True, **kwargs)
+            for chunk in response:
+                on_chunk(chunk)
+            return response
+
+        def generate_content(contents: List[Any], **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            cached = self._cached_model(model, template)
+            if cached is not None:
+                try:
+                    response = call(cached, contents, kwargs)
+                except Exception as e:
+                    if not self._is_stale(e):
+                        raise
+                    self._invalidate(model, template, e)
+                else:
+                    self._account(template, "cached", response, time.perf_counter() - started)
+                    return response
+            # Inline, the instructions and the task are one text part again: exactly the original prompt.
+            response = call(model, [template.instructions + contents[0]] + list(contents[1:]), kwargs)
+            self._account(template, "inline", response, time.perf_counter() - started)
+            return response
+
+        return generate_content
+
+    def prepare(self, model: Any, template: PromptTemplate) -> bool:
+        """Registers the template ahead of the first request (warm-up); True if it will be served cached."""
+        return self._cached_model(model, template) is not None
+
+    def _key(self, model: LazyModel, template: PromptTemplate) -> str:
+        return f"{model.model_name}/{template.display_name}"
+
+    def _cached_model(self, model: Any, template: PromptTemplate) -> Optional[Any]:
+        if not self.enabled or not isinstance(model, LazyModel):
+            return None
+        key = self._key(model, template)
+        registration = self._registrations.get(key)
+        if registration is not None and registration.expires_at > time.time() + 60:
+            return registration.model
+        with self._register_lock:
+            registration = self._registrations.get(key)
+            if registration is not None and registration.expires_at > time.time() + 60:
+                return registration.model
+            if self._failed_until.get(key, 0) > time.time():
+                return None
+            try:
+                registration = self._register(model, template)
+            except Exception as e:
+                # e.g. instructions below the model's minimum cacheable size, or caching not offered for it
+                log.warning("Could not register %s as cached content; sending it inline. Error: %s", template.display_name, e)
+                with self._lock:
+                    self.events["registration_failures"] += 1
+                self._failed_until[key] = time.time() + self.retry_after
+                return None
+            with self._lock:
+                self._registrations[key] = registration
+            return registration.model
+
+    def _register(self, model: LazyModel, template: PromptTemplate) -> _Registration:
+        import google.generativeai as genai
+
+        model.load()  # configures the SDK with the model's API key
+        full_name = f"models/{model.model_name}"
+        for existing in genai.caching.CachedContent.list(page_size=100):
+            if (existing.display_name == template.display_name and existing.model == full_name
+                    and existing.expire_time.timestamp() > time.time() + 300):
+                with self._lock:
+                    self.events["reused"] += 1
+                return _Registration(genai.GenerativeModel.from_cached_content(existing), existing.expire_time.timestamp())
+        cache = genai.caching.CachedContent.create(
+            model=full_name,
+            display_name=template.display_name,
+            system_instruction=template.instructions,
+            ttl=datetime.timedelta(seconds=self.ttl),
+        )
+        with self._lock:
+            self.events["registrations"] += 1
+        return _Registration(genai.GenerativeModel.from_cached_content(cache), cache.expire_time.timestamp())
+
+    def _is_stale(self, error: Exception) -> bool:
+        google_exceptions = sys.modules.get("google.api_core.exceptions")
+        return google_exceptions is not None and isinstance(
+            error, tuple(getattr(google_exceptions, name) for name in STALE_CACHE_ERRORS)
+        )
+
+    def _invalidate(self, model: LazyModel, template: PromptTemplate, error: Exception) -> None:
+        log.warning("Cached content for %s is no longer usable; sending it inline. Error: %s", template.display_name, error)
+        with self._lock:
+            self._registrations.pop(self._key(model, template), None)
+            self.events["invalidations"] += 1
+
+    def _account(self, template: PromptTemplate, mode: str, response: Any, seconds: float) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        values = {
+            "calls": 1,
+            "seconds": seconds,
+            "prompt_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+            "output_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+        }
+        with self._lock:
+            for name, value in values.items():
+                key = (template.name, mode, name)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def stats(self) -> Dict[str, Any]:
+        templates: Dict[str, Dict[str, Dict[str, float]]] = {}
+        with self._lock:
+            for (template, mode, name), value in self.counters.items():
+                templates.setdefault(template, {}).setdefault(mode, {})[name] = value
+            # Seconds until each registered cache expires.
+            active = {key: round(r.expires_at - time.time()) for key, r in self._registrations.items()}
+        for modes in templates.values():
+            for totals in modes.values():
+                calls = totals["calls"]
+                totals["seconds"] = round(totals["seconds"], 3)
+                totals["avg_ms"] = round(totals["seconds"] / calls * 1000, 1)
+                totals["avg_prompt_tokens"] = round(totals["prompt_tokens"] / calls)
+                # Cached tokens are part of prompt_tokens but billed at the reduced cached rate.
+                totals["avg_uncached_prompt_tokens"] = round((totals["prompt_tokens"] - totals["cached_tokens"]) / calls)
+        return {"enabled": self.enabled, "active": active, **self.events, "templates": templates}
@@ -0,0 +1,269 @@
+import asyncio
+import math
+import os
+import random
+import sys
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from scheduler import RateLimited, RateScheduler
+from worker_pool import ModelWorkerPool, PoolSaturatedError
+
+
+class UpstreamTimeout(Exception):
+    """A model call did not finish within its stage deadline."""
+
+
+class CircuitOpenError(Exception):
+    """The upstream has been failing; calls are refused until the breaker lets a probe through."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is temporarily unavailable (circuit open). Please retry shortly.")
+        self.retry_after = retry_after
+
+
+# Errors worth another attempt: upstream overload, upstream 5xx, deadlines and dropped connections.
+RETRYABLE_ERRORS = (UpstreamTimeout, ConnectionError, TimeoutError)
+RETRYABLE_GOOGLE_ERRORS = ("ServiceUnavailable", "ResourceExhausted", "InternalServerError", "DeadlineExceeded",
+                           "GatewayTimeout")
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # Looked up rather than imported: an SDK error can only exist once the SDK has been
+    # imported, and importing it up front costs ~100 ms of every cold start.
+    google_exceptions = sys.modules.get("google.api_core.exceptions")
+    return google_exceptions is not None and isinstance(
+        error, tuple(getattr(google_exceptions, name) for name in RETRYABLE_GOOGLE_ERRORS)
+    )
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive upstream failures and refuses calls for
+    `reset_timeout` seconds. Then one probe call is let through (half-open): success closes
+    the breaker, failure opens it again. Only touched from the event loop, so no locking.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(self.name, math.ceil(remaining))
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                raise CircuitOpenError(self.name, 1)
+            self._probing = True
+
+    def abandon(self) -> None:
+        # The call ended without saying anything about the upstream (cancelled, or never sent).
+        self._probing = False
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class _StageClock:
+    """One stage's deadline, shared by all of its attempts, backoffs and hedges."""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires: Optional[float] = None
+
+    def start(self) -> None:
+        # The clock starts when the first call reaches the upstream, not while it waits for budget or a worker.
+        if self.expires is None:
+            self.expires = time.monotonic() + self.timeout
+
+    def remaining(self) -> float:
+        return self.timeout if self.expires is None else self.expires - time.monotonic()
+
+
+class ResilientCaller:
+    """
+    Runs one model's generate_content calls on the worker pool with a per-stage deadline,
+    retries with full-jitter exponential backoff for retryable errors, an optional hedged
+    second call, and a circuit breaker. Every upstream call (retries and hedges included)
+    first takes its share of the model's RPM/TPM budget from the scheduler.
+
+    `timeout` bounds the whole stage: it starts when the first attempt reaches the upstream
+    and every retry, backoff and hedge comes out of what is left. A timeout therefore ends
+    the stage; it is never retried, and no retry is started whose backoff would outlast it.
+
+    When hedging is on and enough latencies have been seen, a second identical call is
+    started if the first has not answered after max(p95, hedge_min_delay) seconds; the first
+    successful answer wins; a hedge is skipped when the rate budget has no room for it right
+    now. A timed-out call is abandoned, not killed: its worker thread finishes in the
+    background and keeps its pool slot until then.
+    """
+
+    def __init__(self, pool: ModelWorkerPool, name: str, timeout: float = 60.0, retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, hedge: bool = False, hedge_min_delay: float = 1.0,
+                 breaker: Optional[CircuitBreaker] = None, scheduler: Optional[RateScheduler] = None,
+                 retryable: Callable[[BaseException], bool] = is_retryable):
+        self.pool = pool
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.scheduler = scheduler or RateScheduler(name)
+        self.retryable = retryable
+        self._latencies: deque = deque(maxlen=200)
+        self.counters = {"calls": 0, "retries": 0, "timeouts": 0, "failures": 0, "hedges": 0, "hedge_wins": 0,
+                         "short_circuits": 0, "hedges_skipped": 0}
+
+    @classmethod
+    def from_env(cls, pool: ModelWorkerPool, name: str, stage: str, default_timeout: float,
+                 scheduler: Optional[RateScheduler] = None,
+                 retryable: Callable[[BaseException], bool] = is_retryable) -> "ResilientCaller":
+        prefix = stage.upper()
+        return cls(
+            pool, name,
+            timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(default_timeout))),
+            retries=int(os.getenv("MODEL_RETRIES", "2")),
+            backoff_base=float(os.getenv("MODEL_RETRY_BACKOFF", "0.5")),
+            hedge=os.getenv(f"{prefix}_HEDGE", "0").lower() in ("1", "true", "yes"),
+            hedge_min_delay=float(os.getenv("MODEL_HEDGE_MIN_DELAY", "1.0")),
+            breaker=CircuitBreaker(name, int(os.getenv("BREAKER_FAILURES", "5")),
+                                   float(os.getenv("BREAKER_RESET_SECONDS", "30"))),
+            scheduler=scheduler,
+            retryable=retryable,
+        )
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return max(self.hedge_min_delay, ordered[int(0.95 * (len(ordered) - 1))])
+
+    async def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self.counters["calls"] += 1
+        clock = _StageClock(self.timeout)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.counters["short_circuits"] += 1
+                raise
+            try:
+                result = await self._attempt(fn, args, kwargs, clock)
+            except (PoolSaturatedError, RateLimited):
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                error = e
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+            if not self.retryable(error):
+                # The upstream answered (e.g. a 400); it is not down.
+                self.breaker.record_success()
+                raise error
+            self.breaker.record_failure()
+            backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt + 1)))
+            # A timed-out call is still running upstream; another attempt would only pile onto it.
+            if attempt >= self.retries or isinstance(error, UpstreamTimeout) or backoff >= clock.remaining():
+                self.counters["failures"] += 1
+                raise error
+            attempt += 1
+            self.counters["retries"] += 1
+            await asyncio.sleep(backoff)
+
+    async def _timed_call(self, fn, args, kwargs, clock: _StageClock, started: Optional[asyncio.Event] = None,
+                          admitted: bool = False):
+        # The recorded latency covers the upstream call only, not the wait for rate budget or for a worker.
+        tokens = self.scheduler.estimate_tokens(args[0] if args else kwargs.get("contents", []))
+        if not admitted:
+            await self.scheduler.acquire(tokens)
+        start = []
+
+        def on_start():
+            clock.start()
+            start.append(time.perf_counter())
+            if started is not None:
+                started.set()
+
+        try:
+            remaining = clock.remaining()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            result = await self.pool.call(fn, args, kwargs, deadline=remaining, on_start=on_start)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            raise UpstreamTimeout(f"{self.name} did not respond within its {self.timeout:g}s deadline")
+        self._latencies.append(time.perf_counter() - start[0])
+        usage = getattr(result, "usage_metadata", None)
+        self.scheduler.settle(tokens, getattr(usage, "total_token_count", None))
+        return result
+
+    async def _attempt(self, fn, args, kwargs, clock: _StageClock):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._timed_call(fn, args, kwargs, clock)
+
+        started = asyncio.Event()
+        primary = asyncio.ensure_future(self._timed_call(fn, args, kwargs, clock, started))
+        tasks = {primary}
+        try:
+            # The hedge clock starts when the first call reaches the upstream, not while it queues.
+            waiter = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                contents = args[0] if args else kwargs.get("contents", [])
+                if self.scheduler.try_acquire(self.scheduler.estimate_tokens(contents)):
+                    self.counters["hedges"] += 1
+                    tasks.add(asyncio.ensure_future(self._timed_call(fn, args, kwargs, clock, admitted=True)))
+                else:
+                    self.counters["hedges_skipped"] += 1
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.breaker.state, "hedge_delay": self.hedge_delay(), **self.counters,
+                "rate_limit": self.scheduler.stats()}
@@ -0,0 +1,268 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from imaging import OutputEncoding, encode_output
+
+
+class StoredResult:
+    def __init__(self, digest: str, size_bytes: int, thumbnail_bytes: int, product_name: Optional[str],
+                 created_at: float, path: str, thumbnail_path: str):
+        self.digest = digest
+        self.size_bytes = size_bytes
+        self.thumbnail_bytes = thumbnail_bytes
+        self.product_name = product_name
+        self.created_at = created_at
+        self.path = path
+        self.thumbnail_path = thumbnail_path
+
+    @property
+    def has_thumbnail(self) -> bool:
+        return self.thumbnail_bytes > 0
+
+
+class ResultStore:
+    """
+    Generated try-on images on local disk, named by the SHA-256 of their bytes and indexed in
+    SQLite by digest and creation time; any number of request keys can point at one image.
+    The index answers gallery pages and "have we rendered this request before?" without
+    touching the directory.
+
+    Thumbnails are made on a single background thread after each store; re-encoded variants
+    (WebP/AVIF/JPEG, downscaled) are made on first request and kept next to the original.
+    Once all of these exceed `max_bytes`, the least recently served results are deleted.
+    """
+
+    COLUMNS = "digest, bytes, thumbnail_bytes, product_name, created_at"
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024, thumbnail_edge: int = 320):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumbnail_edge = thumbnail_edge
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._thumbnails = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "variant_hits": 0, "variants": 0}
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (digest TEXT PRIMARY KEY, bytes INTEGER NOT NULL,"
+                " thumbnail_bytes INTEGER NOT NULL DEFAULT 0, product_name TEXT, created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS result_requests (request_key TEXT PRIMARY KEY, digest TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS result_requests_digest ON result_requests (digest)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created_at, digest)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS result_variants (digest TEXT NOT NULL, variant TEXT NOT NULL,"
+                " suffix TEXT NOT NULL, bytes INTEGER NOT NULL, PRIMARY KEY (digest, variant))"
+            )
+            self.total_bytes = self._db.execute(
+                "SELECT (SELECT COALESCE(SUM(bytes + thumbnail_bytes), 0) FROM results)"
+                " + (SELECT COALESCE(SUM(bytes), 0) FROM result_variants)"
+            ).fetchone()[0]
+
+    @classmethod
+    def from_env(cls) -> Optional["ResultStore"]:
+        directory = os.getenv("RESULT_DIR", "")
+        if not directory:
+            return None
+        return cls(
+            directory,
+            max_bytes=int(os.getenv("RESULT_STORE_MAX_BYTES", str(1024 * 1024 * 1024))),
+            thumbnail_edge=int(os.getenv("RESULT_THUMBNAIL_EDGE", "320")),
+        )
+
+    def _path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest + suffix)
+
+    def _result(self, row) -> StoredResult:
+        digest = row[0]
+        return StoredResult(digest, row[1], row[2], row[3], row[4],
+                            self._path(digest, ".png"), self._path(digest, ".thumb.jpg"))
+
+    def find(self, request_key: str) -> Optional[StoredResult]:
+        """The stored result for a request key, if its file is still on disk; blocking, so call it off the event loop."""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {self.COLUMNS} FROM results WHERE digest ="
+                " (SELECT digest FROM result_requests WHERE request_key = ?)",
+                (request_key,),
+            ).fetchone()
+        result = self._result(row) if row else None
+        if result is not None and not os.path.exists(result.path):
+            self._delete([result.digest])
+            result = None
+        with self._lock:  # called from worker threads
+            self.counters["hits" if result is not None else "misses"] += 1
+        if result is not None:
+            self._touch(result.digest)
+        return result
+
+    def get(self, digest: str) -> Optional[StoredResult]:
+        """Looks up a result and records the access for eviction; blocking, so call it off the event loop."""
+        with self._lock:
+            row = self._db.execute(f"SELECT {self.COLUMNS} FROM results WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self._touch(digest)
+        return self._result(row)
+
+    def _touch(self, digest: str) -> None:
+        with self._lock, self._db:
+            self._db.execute("UPDATE results SET last_access = ? WHERE digest = ?", (time.time(), digest))
+
+    def put(self, request_key: str, image: bytes, product_name: Optional[str] = None) -> StoredResult:
+        """Writes the image (once per distinct content) and indexes it; blocking, so call it off the event loop."""
+        digest = hashlib.sha256(image).hexdigest()
+        path = self._path(digest, ".png")
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(image)
+            os.replace(temp_path, path)
+
+        now = time.time()
+        with self._lock, self._db:
+            existing = self._db.execute("SELECT bytes + thumbnail_bytes FROM results WHERE digest = ?", (digest,)).fetchone()
+            self._db.execute(
+                "INSERT INTO results (digest, bytes, product_name, created_at, last_access) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (digest) DO UPDATE SET last_access = excluded.last_access",
+                (digest, len(image), product_name, now, now),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO result_requests (request_key, digest) VALUES (?, ?)", (request_key, digest)
+            )
+            if existing is None:
+                self.total_bytes += len(image)
+            self.counters["stores"] += 1
+            row = self._db.execute(f"SELECT {self.COLUMNS} FROM results WHERE digest = ?", (digest,)).fetchone()
+        result = self._result(row)
+        if not result.has_thumbnail:
+            self._thumbnails.submit(self._make_thumbnail, digest)
+        self._evict()
+        return result
+
+    def thumbnail(self, result: StoredResult) -> str:
+        """Path to the result's thumbnail, making it now if the background thread has not yet."""
+        if not result.has_thumbnail or not os.path.exists(result.thumbnail_path):
+            self._make_thumbnail(result.digest)
+        return result.thumbnail_path
+
+    def variant(self, result: StoredResult, encoding: OutputEncoding) -> str:
+        """Path to the result re-encoded as `encoding`, encoding it now on first request; blocking."""
+        if encoding.is_original:
+            return result.path
+        suffix = f".{encoding.key}.{encoding.format}"
+        path = self._path(result.digest, suffix)
+        if os.path.exists(path):
+            self.counters["variant_hits"] += 1
+            return path
+        with open(result.path, "rb") as f:
+            data = encode_output(f.read(), encoding)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock, self._db:
+            added = self._db.execute(
+                "INSERT OR IGNORE INTO result_variants (digest, variant, suffix, bytes) VALUES (?, ?, ?, ?)",
+                (result.digest, encoding.key, suffix, len(data)),
+            ).rowcount
+            if added:
+                self.total_bytes += len(data)
+                self.counters["variants"] += 1
+        self._evict()
+        return path
+
+    def _make_thumbnail(self, digest: str) -> None:
+        path, thumbnail_path = self._path(digest, ".png"), self._path(digest, ".thumb.jpg")
+        if os.path.exists(thumbnail_path):
+            return
+        with Image.open(path) as image:
+            image.draft("RGB", (self.thumbnail_edge, self.thumbnail_edge))
+            image = image.convert("RGB")
+            image.thumbnail((self.thumbnail_edge, self.thumbnail_edge), Image.Resampling.LANCZOS)
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=80, optimize=True)
+        temp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(temp_path, thumbnail_path)
+        with self._lock, self._db:
+            updated = self._db.execute(
+                "UPDATE results SET thumbnail_bytes = ? WHERE digest = ? AND thumbnail_bytes = 0",
+                (buffer.tell(), digest),
+            ).rowcount
+            if updated:
+                self.total_bytes += buffer.tell()
+
+    def page(self, limit: int, before: Optional[Tuple[float, str]] = None) -> List[StoredResult]:
+        """Newest-first results, continuing after the (created_at, digest) of the previous page's last item."""
+        with self._lock:
+            if before is None:
+                rows = self._db.execute(
+                    f"SELECT {self.COLUMNS} FROM results ORDER BY created_at DESC, digest DESC LIMIT ?", (limit,)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    f"SELECT {self.COLUMNS} FROM results WHERE created_at < ? OR (created_at = ? AND digest < ?)"
+                    " ORDER BY created_at DESC, digest DESC LIMIT ?",
+                    (before[0], before[0], before[1], limit),
+                ).fetchall()
+        return [self._result(row) for row in rows]
+
+    def _evict(self) -> None:
+        if self.total_bytes <= self.max_bytes:
+            return
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT digest, bytes + thumbnail_bytes + (SELECT COALESCE(SUM(bytes), 0) FROM result_variants"
+                " WHERE result_variants.digest = results.digest) FROM results ORDER BY last_access"
+            ).fetchall()
+        victims, excess = [], self.total_bytes - self.max_bytes
+        for digest, size in rows:
+            if excess <= 0:
+                break
+            victims.append(digest)
+            excess -= size
+        self._delete(victims)
+
+    def _delete(self, digests: List[str]) -> None:
+        for digest in digests:
+            with self._lock, self._db:
+                row = self._db.execute("SELECT bytes + thumbnail_bytes FROM results WHERE digest = ?", (digest,)).fetchone()
+                if row is None:
+                    continue
+                variants = self._db.execute(
+                    "SELECT suffix, bytes FROM result_variants WHERE digest = ?", (digest,)
+                ).fetchall()
+                self._db.execute("DELETE FROM results WHERE digest = ?", (digest,))
+                self._db.execute("DELETE FROM result_requests WHERE digest = ?", (digest,))
+                self._db.execute("DELETE FROM result_variants WHERE digest = ?", (digest,))
+                self.total_bytes -= row[0] + sum(size for _, size in variants)
+                self.counters["evictions"] += 1
+            for suffix in [".png", ".thumb.jpg"] + [suffix for suffix, _ in variants]:
+                try:
+                    os.remove(self._path(digest, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {"results": count, "bytes": self.total_bytes, "max_bytes": self.max_bytes, **self.counters}
+
+    def close(self) -> None:
+        self._thumbnails.shutdown(wait=True)
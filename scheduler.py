@@ -0,0 +1,191 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Optional
+
+# Lower runs first. Interactive shoppers beat batch fan-out, which beats catalog precompute.
+PRIORITIES = {"interactive": 0, "batch": 1, "precompute": 2}
+
+# Who the current work is for, set per request (middleware) and per kind of work (endpoints).
+current_priority: ContextVar[str] = ContextVar("current_priority", default="interactive")
+current_client: ContextVar[str] = ContextVar("current_client", default="anonymous")
+
+# Normalized images are at most 1536px, i.e. up to four 768px tiles of 258 tokens each.
+IMAGE_PART_TOKENS = 4 * 258
+
+
+class RateLimited(Exception):
+    """The model's RPM/TPM budget cannot serve this call within the scheduler's max wait."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"The {name} is at its rate limit. Please retry in about {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float) -> None:
+        # Settle an estimate against the real usage; the level may go negative (debt).
+        self._refill()
+        self.level -= amount
+
+
+class _Waiter:
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class RateScheduler:
+    """
+    Admits calls to one model at the pace of its RPM and TPM quotas (token buckets refilled
+    continuously; 0 disables a bucket). Calls that cannot go now wait in priority order;
+    within a priority, clients take turns, so one tenant's burst cannot starve the others.
+
+    A call whose estimated wait exceeds `max_wait` is refused with RateLimited and a
+    Retry-After estimate. Token use is estimated up front and corrected by `settle()` once
+    the response's usage metadata is known. Only touched from the event loop.
+    """
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, max_wait: float = 30.0, output_tokens: int = 0):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_wait = max_wait
+        self.output_tokens = output_tokens
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.counters = {"immediate": 0, "waited": 0, "rejected": 0}
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, output_tokens: int) -> "RateScheduler":
+        return cls(
+            name,
+            rpm=float(os.getenv(f"{prefix}_RPM", "0")),
+            tpm=float(os.getenv(f"{prefix}_TPM", "0")),
+            max_wait=float(os.getenv("SCHEDULER_MAX_WAIT", "30")),
+            output_tokens=output_tokens,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def estimate_tokens(self, contents: Any) -> int:
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        prompt = sum(len(part) // 4 if isinstance(part, str) else IMAGE_PART_TOKENS for part in parts)
+        return prompt + self.output_tokens
+
+    def _wait_time(self, requests: float, tokens: float) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(requests))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _take(self, tokens: float) -> None:
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    def queued(self) -> int:
+        return sum(len(waiters) for clients in self._queues.values() for waiters in clients.values())
+
+    def try_acquire(self, tokens: float) -> bool:
+        """Takes budget only if it is available right now and nobody is waiting (used for hedges)."""
+        if not self.enabled:
+            return True
+        if self.queued() or self._wait_time(1, tokens) > 0:
+            return False
+        self._take(tokens)
+        self.counters["immediate"] += 1
+        return True
+
+    async def acquire(self, tokens: float) -> None:
+        if self.try_acquire(tokens):
+            return
+        priority, client = PRIORITIES.get(current_priority.get(), 0), current_client.get()
+        # Ahead of us: everything of higher priority, and at our priority each client's
+        # turns up to ours in the rotation (a client with a long backlog does not count in full).
+        ahead = [w for level, clients in self._queues.items() if level < priority
+                 for waiters in clients.values() for w in waiters]
+        clients = self._queues.get(priority, {})
+        turns = len(clients.get(client, ())) + 1
+        ahead += [w for waiters in clients.values() for w in list(waiters)[:turns]]
+        wait = self._wait_time(len(ahead) + 1, sum(w.tokens for w in ahead) + tokens)
+        if wait > self.max_wait:
+            self.counters["rejected"] += 1
+            raise RateLimited(self.name, math.ceil(wait))
+
+        waiter = _Waiter(tokens)
+        clients = self._queues.setdefault(priority, OrderedDict())
+        clients.setdefault(client, deque()).append(waiter)
+        self.counters["waited"] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await waiter.future
+
+    def settle(self, estimated: float, actual: Optional[float]) -> None:
+        if self.tokens is not None and actual is not None:
+            self.tokens.adjust(actual - estimated)
+
+    def _next(self):
+        # Highest priority first; within it, the client at the front of the rotation.
+        for priority in sorted(self._queues):
+            clients = self._queues[priority]
+            while clients:
+                client, waiters = next(iter(clients.items()))
+                while waiters and waiters[0].future.done():
+                    waiters.popleft()  # cancelled while waiting
+                if waiters:
+                    return clients, client, waiters
+                del clients[client]
+        return None
+
+    async def _dispatch(self) -> None:
+        while True:
+            head = self._next()
+            if head is None:
+                return
+            clients, client, waiters = head
+            delay = self._wait_time(1, waiters[0].tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            waiter = waiters.popleft()
+            self._take(waiter.tokens)
+            waiter.future.set_result(None)
+            clients.move_to_end(client)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "queued": self.queued(),
+            "requests_available": round(self.requests.level, 2) if self.requests is not None else None,
+            "tokens_available": round(self.tokens.level) if self.tokens is not None else None,
+            **self.counters,
+        }
@@ -50,7 +50,8 @@ async function submitTryOn() {
   try {
     const res = await fetch(endpoint, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      // WebP/AVIF are a fraction of the PNG's size; the server falls back to PNG if it can't encode them.
+      headers: { "Content-Type": "application/json", "Accept": "image/avif,image/webp,image/png" },
       body: JSON.stringify(payload)
     });
 
@@ -64,6 +65,7 @@ async function submitTryOn() {
     if (imageBlob.size > 0) {
       const imageUrl = URL.createObjectURL(imageBlob);
       document.getElementById("resultImage").src = imageUrl;
+      document.getElementById("resultImage").dataset.extension = (imageBlob.type.split("/")[1] || "png").replace("jpeg", "jpg");
 
       const downloadBtn = document.getElementById('downloadBtn');
       downloadBtn.style.display = 'flex';
@@ -254,7 +256,7 @@ function setupDownloadButton() {
         }
         const link = document.createElement('a');
         link.href = imageUrl;
-        link.download = 'virtual-try-on-result.png';
+        link.download = `virtual-try-on-result.${resultImage.dataset.extension || 'png'}`;
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+
+def request_key(endpoint: str, images: Iterable[bytes], *fields: Optional[str]) -> str:
+    """Hash of everything that can change the generated image: the endpoint, image bytes and prompt fields."""
+    digest = hashlib.sha256(endpoint.encode())
+    for image_bytes in images:
+        digest.update(b"\0img")
+        digest.update(hashlib.sha256(image_bytes).digest())
+    for field in fields:
+        digest.update(b"\0field")
+        digest.update((field or "").encode())
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller for a key starts the work,
+    later callers with the same key wait for that same result instead of starting their own.
+
+    The work runs in its own task, so the computation is not cancelled when the caller that
+    started it disconnects while others are still waiting.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.counters = {"leaders": 0, "coalesced": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns `(result, shared)`; `shared` is True when this caller piggybacked on another's call."""
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.counters["coalesced"] += 1
+        else:
+            self.counters["leaders"] += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self._in_flight)}
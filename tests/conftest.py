@@ -0,0 +1,11 @@
+"""
+Tests import the app against the offline fake backend (fake_backend.py), without a result
+store, so they need neither Gemini credentials nor a writable gallery directory.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRYON_BACKEND", "fake")
+os.environ.setdefault("RESULT_DIR", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
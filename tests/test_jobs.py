@@ -0,0 +1,76 @@
+"""
+Async jobs end to end against FakeModel, on both job stores: the event stream sees every stage
+of a job that finishes while it is being streamed. Run from the repository root: python -m pytest -q
+"""
+import asyncio
+import base64
+import io
+import time
+
+import httpx
+import pytest
+from PIL import Image
+
+import app
+from fake_backend import FakeModel
+from jobs import InMemoryJobStore, JobRunner, SqliteJobStore
+
+
+def image_b64(color: str) -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, "JPEG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def job_runner(request, tmp_path, monkeypatch):
+    store = InMemoryJobStore() if request.param == "memory" else SqliteJobStore(str(tmp_path / "jobs.sqlite3"))
+    runner = JobRunner(store, workers=2, error_mapper=app.job_error)
+    monkeypatch.setattr(app, "job_runner", runner)
+    monkeypatch.setattr(app, "description_model", FakeModel("text", latency=0.1))
+    monkeypatch.setattr(app, "image_generation_model", FakeModel("image", latency=0.2, output_bytes=1024))
+    return runner
+
+
+def test_event_stream_follows_a_job_to_completion(job_runner):
+    async def scenario():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            body = {"productName": "Tee", "productSize": "M", "productDesc": "cotton",
+                    "personImage": image_b64("blue"), "productImage": image_b64("red")}
+            created = await client.post("/jobs", json=body)
+            job_id = created.json()["id"]
+            started = time.monotonic()
+            async with client.stream("GET", f"/jobs/{job_id}/events") as response:
+                lines = [line async for line in response.aiter_lines()]
+            elapsed = time.monotonic() - started
+            result = await client.get(f"/jobs/{job_id}/result")
+        await job_runner.close()
+        return created, lines, elapsed, result
+
+    created, lines, elapsed, result = asyncio.run(scenario())
+    assert created.status_code == 202
+    events = [line.split(": ", 1)[1] for line in lines if line.startswith("event: ")]
+    assert events == ["started", "decoded", "brief_ready", "image_ready", "done"]
+    assert elapsed < 5  # not woken by the 15s keep-alive after a missed notification
+    assert result.status_code == 200
+    assert result.headers["content-type"] == "image/png"
+
+
+def test_wait_for_change_returns_at_once_for_an_event_already_published(job_runner):
+    async def handler(job_id, on_stage):
+        return b"image", None
+
+    async def scenario():
+        seen = job_runner.version
+        job = await job_runner.submit(handler)
+        while not (await job_runner.get(job.id)).done:
+            await asyncio.sleep(0.01)
+        changed = await job_runner.wait_for_change(seen, timeout=0.01)
+        finished = await job_runner.get(job.id)
+        await job_runner.close()
+        return changed, finished
+
+    changed, finished = asyncio.run(scenario())
+    assert changed
+    assert finished.status == "succeeded"
@@ -0,0 +1,204 @@
+"""
+ResilientCaller against the offline FakeModel: circuit breaker states, retry counts, the
+per-stage deadline and Step-2 hedging. Run from the repository root: python -m pytest -q
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from fake_backend import FakeModel, FakeUpstreamError
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, UpstreamTimeout
+from scheduler import RateScheduler
+from worker_pool import ModelWorkerPool
+
+
+def make_caller(model_failures: float = 0.0, timeout: float = 5.0, retries: int = 0, failure_threshold: int = 3,
+                reset_timeout: float = 0.2, **model_options):
+    model = FakeModel("text", latency=model_options.pop("latency", 0.01), failure_rate=model_failures, **model_options)
+    caller = ResilientCaller(ModelWorkerPool(max_concurrency=4, max_queue=8), "test model", timeout=timeout,
+                             retries=retries, backoff_base=0.001, backoff_max=0.01,
+                             breaker=CircuitBreaker("test model", failure_threshold, reset_timeout))
+    return caller, model
+
+
+async def call(caller, model):
+    return await caller.call(model.generate_content, ["prompt"])
+
+
+def test_breaker_opens_after_consecutive_failures_and_short_circuits():
+    async def scenario():
+        caller, model = make_caller(model_failures=1.0)
+        for _ in range(3):
+            with pytest.raises(FakeUpstreamError):
+                await call(caller, model)
+        assert caller.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await call(caller, model)
+        return caller, model
+
+    caller, model = asyncio.run(scenario())
+    assert model.calls == 3
+    assert caller.counters["short_circuits"] == 1
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    async def scenario():
+        caller, model = make_caller(model_failures=1.0)
+        for _ in range(3):
+            with pytest.raises(FakeUpstreamError):
+                await call(caller, model)
+        await asyncio.sleep(0.25)
+        model.failure_rate, model.latency = 0.0, 0.1
+        probe = asyncio.ensure_future(call(caller, model))
+        await asyncio.sleep(0.02)
+        assert caller.breaker.state == "half_open"
+        with pytest.raises(CircuitOpenError):
+            await call(caller, model)  # only the probe may run while half-open
+        await probe
+        return caller
+
+    assert asyncio.run(scenario()).breaker.state == "closed"
+
+
+def test_failed_probe_reopens_the_breaker():
+    async def scenario():
+        caller, model = make_caller(model_failures=1.0)
+        for _ in range(3):
+            with pytest.raises(FakeUpstreamError):
+                await call(caller, model)
+        await asyncio.sleep(0.25)
+        with pytest.raises(FakeUpstreamError):
+            await call(caller, model)
+        return caller
+
+    assert asyncio.run(scenario()).breaker.state == "open"
+
+
+def test_retryable_failures_are_retried_up_to_the_limit():
+    async def scenario():
+        caller, model = make_caller(model_failures=1.0, retries=2, failure_threshold=10)
+        with pytest.raises(FakeUpstreamError):
+            await call(caller, model)
+        return caller, model
+
+    caller, model = asyncio.run(scenario())
+    assert model.calls == 3
+    assert caller.counters["retries"] == 2
+    assert caller.counters["failures"] == 1
+
+
+def test_timeout_ends_the_stage_without_retrying():
+    async def scenario():
+        caller, model = make_caller(timeout=0.1, retries=2, slow_rate=1.0, slow_latency=0.5)
+        started = time.monotonic()
+        with pytest.raises(UpstreamTimeout):
+            await call(caller, model)
+        return caller, model, time.monotonic() - started
+
+    caller, model, elapsed = asyncio.run(scenario())
+    assert model.calls == 1
+    assert caller.counters["timeouts"] == 1
+    assert caller.counters["retries"] == 0
+    assert elapsed < 0.3
+
+
+def test_retries_share_the_stage_deadline():
+    async def scenario():
+        caller, model = make_caller(model_failures=1.0, timeout=0.12, retries=10, failure_threshold=100, latency=0.05)
+        started = time.monotonic()
+        with pytest.raises((FakeUpstreamError, UpstreamTimeout)):
+            await call(caller, model)
+        return model, time.monotonic() - started
+
+    model, elapsed = asyncio.run(scenario())
+    assert model.calls <= 3
+    assert elapsed < 0.3
+
+
+class SequencedModel(FakeModel):
+    """FakeModel whose calls take the given latencies in order (then `latency`), to stage a slow primary."""
+
+    def __init__(self, latencies, latency: float = 0.01):
+        super().__init__("text", latency=0.0)
+        self.latencies = list(latencies)
+        self.default_latency = latency
+        self.lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        with self.lock:
+            delay = self.latencies.pop(0) if self.latencies else self.default_latency
+        time.sleep(delay)
+        return super().generate_content(contents, **kwargs)
+
+
+def make_hedging_caller(model, hedge_min_delay: float = 0.1, scheduler=None):
+    return ResilientCaller(ModelWorkerPool(max_concurrency=4, max_queue=8), "test model", timeout=5.0, retries=0,
+                           hedge=True, hedge_min_delay=hedge_min_delay, scheduler=scheduler)
+
+
+async def warm_up(caller, model, calls: int = 20):
+    # The hedge delay is only known once 20 latencies have been recorded.
+    for _ in range(calls):
+        await call(caller, model)
+
+
+def test_hedge_delay_is_the_larger_of_p95_and_the_minimum():
+    async def scenario():
+        model = SequencedModel([], latency=0.05)
+        slow_minimum = make_hedging_caller(model, hedge_min_delay=0.2)
+        fast_minimum = make_hedging_caller(model, hedge_min_delay=0.001)
+        assert fast_minimum.hedge_delay() is None
+        await warm_up(slow_minimum, model)
+        await warm_up(fast_minimum, model)
+        return slow_minimum.hedge_delay(), fast_minimum.hedge_delay()
+
+    slow_minimum, fast_minimum = asyncio.run(scenario())
+    assert slow_minimum == 0.2
+    assert 0.05 <= fast_minimum < 0.2
+
+
+def test_hedge_fires_after_the_delay_and_the_first_success_wins():
+    async def scenario():
+        model = SequencedModel([0.01] * 20 + [1.0, 0.01])
+        caller = make_hedging_caller(model, hedge_min_delay=0.1)
+        await warm_up(caller, model)
+        started = time.monotonic()
+        await call(caller, model)
+        return caller, time.monotonic() - started
+
+    caller, elapsed = asyncio.run(scenario())
+    assert caller.counters["hedges"] == 1
+    assert caller.counters["hedge_wins"] == 1
+    assert 0.1 <= elapsed < 0.5
+
+
+def test_primary_that_finishes_first_wins_over_its_hedge():
+    async def scenario():
+        model = SequencedModel([0.01] * 20 + [0.2, 1.0])
+        caller = make_hedging_caller(model, hedge_min_delay=0.1)
+        await warm_up(caller, model)
+        started = time.monotonic()
+        await call(caller, model)
+        return caller, time.monotonic() - started
+
+    caller, elapsed = asyncio.run(scenario())
+    assert caller.counters["hedges"] == 1
+    assert caller.counters["hedge_wins"] == 0
+    assert elapsed < 0.5
+
+
+def test_hedge_is_skipped_without_rate_budget():
+    async def scenario():
+        model = SequencedModel([0.01] * 20 + [0.3])
+        caller = make_hedging_caller(model, hedge_min_delay=0.1, scheduler=RateScheduler("test model", rpm=60))
+        await warm_up(caller, model)
+        caller.scheduler.requests.level = 1  # exactly the primary's request; refills at one per second
+        await call(caller, model)
+        return caller, model
+
+    caller, model = asyncio.run(scenario())
+    assert caller.counters["hedges"] == 0
+    assert caller.counters["hedges_skipped"] == 1
+    assert model.calls == 21
@@ -0,0 +1,75 @@
+"""
+RateScheduler ordering and refusals under an RPM limit, alone and behind a ResilientCaller.
+Run from the repository root: python -m pytest -q
+"""
+import asyncio
+
+import pytest
+
+from fake_backend import FakeModel
+from resilience import ResilientCaller
+from scheduler import RateLimited, RateScheduler, current_client, current_priority
+from worker_pool import ModelWorkerPool
+
+
+def drained_scheduler(rpm: float = 1200, max_wait: float = 5.0) -> RateScheduler:
+    # 1200 RPM grants one call every 50ms once the initial burst is spent.
+    scheduler = RateScheduler("test model", rpm=rpm, max_wait=max_wait)
+    scheduler.requests.level = 0
+    return scheduler
+
+
+async def queue_call(scheduler: RateScheduler, order: list, label: str, priority: str, client: str = "anonymous"):
+    current_priority.set(priority)
+    current_client.set(client)
+    await scheduler.acquire(1)
+    order.append(label)
+
+
+def test_interactive_calls_overtake_queued_batch_calls():
+    async def scenario():
+        scheduler, order = drained_scheduler(), []
+        tasks = [asyncio.create_task(queue_call(scheduler, order, f"batch-{i}", "batch")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(queue_call(scheduler, order, f"interactive-{i}", "interactive"))
+                  for i in range(2)]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive-0", "interactive-1", "batch-0", "batch-1", "batch-2"]
+
+
+def test_clients_take_turns_within_a_priority():
+    async def scenario():
+        scheduler, order = drained_scheduler(), []
+        tasks = [asyncio.create_task(queue_call(scheduler, order, f"a-{i}", "interactive", "a")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(queue_call(scheduler, order, "b-0", "interactive", "b")))
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["a-0", "b-0", "a-1", "a-2"]
+
+
+def test_wait_beyond_max_wait_is_refused_with_retry_after():
+    async def scenario():
+        scheduler = drained_scheduler(rpm=60, max_wait=0.5)
+        with pytest.raises(RateLimited) as refused:
+            await scheduler.acquire(1)
+        return scheduler, refused.value
+
+    scheduler, error = asyncio.run(scenario())
+    assert error.retry_after == 1
+    assert scheduler.counters["rejected"] == 1
+
+
+def test_rate_limited_upstream_call_is_not_made():
+    async def scenario():
+        model = FakeModel("text", latency=0.0)
+        caller = ResilientCaller(ModelWorkerPool(max_concurrency=2, max_queue=4), "test model",
+                                 scheduler=drained_scheduler(rpm=60, max_wait=0.5))
+        with pytest.raises(RateLimited):
+            await caller.call(model.generate_content, ["prompt"])
+        return model
+
+    assert asyncio.run(scenario()).calls == 0
@@ -0,0 +1,121 @@
+"""
+speculative_step2 (latencyMode=fast) against FakeModel: which image wins, what is counted and
+what the result store may keep. Run from the repository root: python -m pytest -q
+"""
+import asyncio
+import time
+
+import pytest
+
+import app
+from fake_backend import FakeModel, FakeUpstreamError
+from resilience import CircuitBreaker
+from timing import StageTimer
+
+SPECULATIVE_BRIEF = "speculative brief"
+MODEL_BRIEF = "model brief"
+
+
+class BriefTimedModel(FakeModel):
+    """Image model whose latency and failures depend on the brief in the prompt."""
+
+    def __init__(self, latencies: dict, failing: tuple = ()):
+        super().__init__("image", latency=0.0, output_bytes=1024)
+        self.latencies = latencies
+        self.failing = failing
+        self.briefs = []
+
+    def generate_content(self, contents, **kwargs):
+        brief = next(brief for brief in self.latencies if brief in contents[0])
+        self.briefs.append(brief)
+        time.sleep(self.latencies[brief])
+        if brief in self.failing:
+            raise FakeUpstreamError(f"Injected failure for the {brief}")
+        return super().generate_content(contents, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def image_calls(monkeypatch):
+    monkeypatch.setattr(app.image_calls, "retries", 0)
+    monkeypatch.setattr(app.image_calls, "breaker", CircuitBreaker("image model"))
+    monkeypatch.setattr(app, "image_generation_model", app.image_generation_model)
+
+
+def speculation(outcome: str) -> float:
+    return app.SPECULATION.value(endpoint="single", outcome=outcome)
+
+
+def duplicates() -> float:
+    return app.SPECULATION_DUPLICATES.value(endpoint="single")
+
+
+def run_step2(model: BriefTimedModel, brief_delay: float, brief_fails: bool = False):
+    async def model_brief():
+        await asyncio.sleep(brief_delay)
+        if brief_fails:
+            raise FakeUpstreamError("Injected Step-1 failure")
+        return MODEL_BRIEF
+
+    async def scenario():
+        app.set_model_clients(image=model)
+        brief_task = asyncio.create_task(model_brief())
+        return await app.speculative_step2(brief_task, SPECULATIVE_BRIEF, "speculative", "person", ["product"],
+                                           False, StageTimer())
+
+    return asyncio.run(scenario())
+
+
+def test_speculative_image_wins_and_is_not_stored():
+    won, duplicated = speculation("speculative_won"), duplicates()
+    model = BriefTimedModel({SPECULATIVE_BRIEF: 0.15, MODEL_BRIEF: 0.4})
+    image, source = run_step2(model, brief_delay=0.05)
+    assert image == model.image
+    assert source == "speculative"
+    assert speculation("speculative_won") == won + 1
+    assert duplicates() == duplicated + 1  # the regular call had started before the speculative image won
+    assert not app.TryOnResult(image, StageTimer(), source).storable
+
+
+def test_model_brief_wins_when_the_speculative_image_is_slower():
+    won, duplicated = speculation("brief_won"), duplicates()
+    model = BriefTimedModel({SPECULATIVE_BRIEF: 0.5, MODEL_BRIEF: 0.05})
+    image, source = run_step2(model, brief_delay=0.05)
+    assert source == "model"
+    assert speculation("brief_won") == won + 1
+    assert duplicates() == duplicated + 1
+    assert app.TryOnResult(image, StageTimer(), source).storable
+
+
+def test_failed_brief_keeps_the_speculative_image_without_a_second_call():
+    won, duplicated = speculation("speculative_won"), duplicates()
+    model = BriefTimedModel({SPECULATIVE_BRIEF: 0.15, MODEL_BRIEF: 0.05})
+    _, source = run_step2(model, brief_delay=0.05, brief_fails=True)
+    assert source == "speculative"
+    assert model.briefs == [SPECULATIVE_BRIEF]
+    assert speculation("speculative_won") == won + 1
+    assert duplicates() == duplicated
+
+
+def test_both_image_calls_failing_raises():
+    failed, duplicated = speculation("failed"), duplicates()
+    model = BriefTimedModel({SPECULATIVE_BRIEF: 0.05, MODEL_BRIEF: 0.05}, failing=(SPECULATIVE_BRIEF, MODEL_BRIEF))
+    with pytest.raises(FakeUpstreamError, match="model brief"):
+        run_step2(model, brief_delay=0.1)
+    assert sorted(model.briefs) == [MODEL_BRIEF, SPECULATIVE_BRIEF]
+    assert speculation("failed") == failed + 1
+    assert duplicates() == duplicated + 1
+
+
+def test_failed_brief_and_image_raises_the_image_error():
+    failed = speculation("failed")
+    model = BriefTimedModel({SPECULATIVE_BRIEF: 0.05, MODEL_BRIEF: 0.05}, failing=(SPECULATIVE_BRIEF,))
+    with pytest.raises(FakeUpstreamError, match="speculative brief"):
+        run_step2(model, brief_delay=0.1, brief_fails=True)
+    assert model.briefs == [SPECULATIVE_BRIEF]
+    assert speculation("failed") == failed + 1
+
+
+def test_fallback_results_are_not_stored():
+    assert not app.TryOnResult(b"", StageTimer(), "fallback").storable
+    assert not app.TryOnResult(b"", StageTimer(), "speculative+precomputed").storable
+    assert app.TryOnResult(b"", StageTimer(), "cache").storable
@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+class _Span:
+    def __init__(self, description: str):
+        self.description = description
+
+
+class StageTimer:
+    """
+    Collects wall-clock timings for the stages of one request.
+
+    `header()` renders them as a Server-Timing header so they show up in the
+    browser's network panel next to the response.
+    """
+
+    def __init__(self):
+        self.stages: List[Tuple[str, float, str]] = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, description: str = ""):
+        span = _Span(description)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.stages.append((name, time.perf_counter() - start, span.description))
+
+    def record(self, name: str, seconds: float, description: str = "") -> None:
+        self.stages.append((name, seconds, description))
+
+    def total(self) -> float:
+        return time.perf_counter() - self._started
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: round(seconds * 1000, 1) for name, seconds, _ in self.stages}
+
+    def header(self) -> str:
+        entries = []
+        for name, seconds, description in self.stages:
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(entries)
@@ -0,0 +1,194 @@
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from python_multipart.multipart import MultipartParser, MultipartParseError, parse_options_header
+from starlette.requests import Request
+
+# Magic numbers for the image formats we accept. Checked against the first bytes of every
+# file part so a bad upload is rejected before the rest of it is read.
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+SNIFF_BYTES = 12
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class UploadLimits:
+    def __init__(self, max_file_bytes: int, max_total_bytes: int, max_files: int, max_field_bytes: int = 64 * 1024,
+                 spool_bytes: int = 1024 * 1024):
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_files = max_files
+        self.max_field_bytes = max_field_bytes
+        self.spool_bytes = spool_bytes
+
+    @classmethod
+    def from_env(cls) -> "UploadLimits":
+        return cls(
+            max_file_bytes=int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(15 * 1024 * 1024))),
+            max_total_bytes=int(os.getenv("UPLOAD_MAX_TOTAL_BYTES", str(40 * 1024 * 1024))),
+            max_files=int(os.getenv("UPLOAD_MAX_FILES", "9")),
+        )
+
+
+class UploadedImage:
+    """One file part, held in a SpooledTemporaryFile (memory up to `spool_bytes`, then disk)."""
+
+    def __init__(self, field: str, filename: Optional[str], spool_bytes: int):
+        self.field = field
+        self.filename = filename
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self.size = 0
+        self.content_type: Optional[str] = None
+        self._head = b""
+
+    def read_bytes(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class _FormReader:
+    def __init__(self, limits: UploadLimits, file_fields: List[str]):
+        self.limits = limits
+        self.file_fields = set(file_fields)
+        self.fields: Dict[str, str] = {}
+        self.files: Dict[str, List[UploadedImage]] = {}
+        self.total_bytes = 0
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._field_name = ""
+        self._field_data = bytearray()
+        self._file: Optional[UploadedImage] = None
+
+    def all_files(self) -> List[UploadedImage]:
+        return [f for files in self.files.values() for f in files]
+
+    # --- python-multipart callbacks ---
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._field_data = bytearray()
+        self._file = None
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._field_name = options.get(b"name", b"").decode("latin-1")
+        filename = options.get(b"filename")
+        if filename is None:
+            return
+        if self._field_name not in self.file_fields:
+            raise UploadRejected(400, f"Unexpected file field '{self._field_name}'.")
+        if len(self.all_files()) >= self.limits.max_files:
+            raise UploadRejected(413, f"Too many images; at most {self.limits.max_files} are allowed.")
+        self._file = UploadedImage(self._field_name, filename.decode("utf-8", "replace"), self.limits.spool_bytes)
+        self.files.setdefault(self._field_name, []).append(self._file)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        self.total_bytes += len(chunk)
+        if self.total_bytes > self.limits.max_total_bytes:
+            raise UploadRejected(413, f"Upload exceeds {self.limits.max_total_bytes} bytes.")
+
+        upload = self._file
+        if upload is None:
+            self._field_data += chunk
+            if len(self._field_data) > self.limits.max_field_bytes:
+                raise UploadRejected(413, f"Form field '{self._field_name}' is too large.")
+            return
+
+        upload.size += len(chunk)
+        if upload.size > self.limits.max_file_bytes:
+            raise UploadRejected(413, f"Image '{upload.field}' exceeds {self.limits.max_file_bytes} bytes.")
+        if upload.content_type is None:
+            upload._head += chunk[:SNIFF_BYTES]
+            if len(upload._head) >= SNIFF_BYTES:
+                self._check_format(upload)
+        upload.file.write(chunk)
+
+    def on_part_end(self) -> None:
+        upload = self._file
+        if upload is None:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", "replace")
+            return
+        if upload.content_type is None:
+            # Tiny file: fewer than SNIFF_BYTES arrived, check whatever we have.
+            self._check_format(upload)
+
+    def _check_format(self, upload: UploadedImage) -> None:
+        upload.content_type = sniff_image_type(upload._head)
+        if upload.content_type is None:
+            raise UploadRejected(415, f"Image '{upload.field}' is not a JPEG, PNG, WebP or GIF file.")
+
+
+async def read_multipart_images(request: Request, file_fields: List[str], limits: UploadLimits):
+    """
+    Streams a multipart/form-data body, spooling each file part as it arrives.
+
+    Size, count and format limits are enforced while reading, so an oversized or
+    non-image upload is rejected without buffering the rest of the body.
+    Returns `(fields, files)`; the caller owns the files and must close them.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadRejected(415, "Expected a multipart/form-data body.")
+
+    declared_length = request.headers.get("content-length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > limits.max_total_bytes:
+        raise UploadRejected(413, f"Upload exceeds {limits.max_total_bytes} bytes.")
+
+    reader = _FormReader(limits, file_fields)
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": reader.on_part_begin,
+        "on_part_data": reader.on_part_data,
+        "on_part_end": reader.on_part_end,
+        "on_header_field": reader.on_header_field,
+        "on_header_value": reader.on_header_value,
+        "on_header_end": reader.on_header_end,
+        "on_headers_finished": reader.on_headers_finished,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError:
+        for upload in reader.all_files():
+            upload.close()
+        raise UploadRejected(400, "Invalid multipart body.")
+    except BaseException:
+        for upload in reader.all_files():
+            upload.close()
+        raise
+    return reader.fields, reader.files
@@ -0,0 +1,110 @@
+import asyncio
+import contextlib
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the model worker pool cannot accept more work."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class ModelWorkerPool:
+    """
+    Runs the blocking Gemini SDK calls on a bounded thread pool so they never
+    block the event loop.
+
+    - At most `max_concurrency` model calls run at once (one thread each).
+    - `admit()` lets up to `max_concurrency + max_queue` requests into the pipeline;
+      anyone beyond that is rejected immediately with a 429. Admission is per request,
+      so a request that got in is never rejected between Step 1 and Step 2.
+    - A call that waits longer than `queue_timeout` seconds for a thread is rejected with a 503.
+    - A call keeps its slot until its thread returns, even if the caller stopped waiting, so
+      abandoned calls never pile up in the executor's own queue.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 32, queue_timeout: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.admitted = 0
+        self.active = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls) -> "ModelWorkerPool":
+        return cls(
+            max_concurrency=int(os.getenv("MODEL_MAX_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("MODEL_MAX_QUEUE", "32")),
+            queue_timeout=float(os.getenv("MODEL_QUEUE_TIMEOUT", "30")),
+        )
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        if self.admitted >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise PoolSaturatedError(429, "Too many try-on requests in flight. Please retry shortly.", self._retry_after())
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.admitted -= 1
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await self.call(fn, args, kwargs)
+
+    async def call(self, fn: Callable[..., Any], args: tuple = (), kwargs: Optional[dict] = None,
+                   deadline: Optional[float] = None, on_start: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Runs fn(*args, **kwargs) on a worker thread. `on_start` is called once the call has a
+        thread; `deadline` then bounds the wait for its result (asyncio.TimeoutError).
+        """
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PoolSaturatedError(503, "Model workers are saturated. Please retry shortly.", self._retry_after())
+
+        self.active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **(kwargs or {})))
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        if on_start is not None:
+            on_start()
+        return await asyncio.wait_for(asyncio.shield(future), deadline)
+
+    def _release(self, future: Optional[asyncio.Future] = None) -> None:
+        self.active -= 1
+        self._semaphore.release()
+        if future is not None and not future.cancelled():
+            future.exception()  # the caller may have stopped waiting; don't log "never retrieved"
+
+    def _retry_after(self) -> int:
+        # Rough estimate: a few seconds per "generation" of queued requests ahead of the caller.
+        backlog = max(0, self.admitted - self.max_concurrency)
+        return 5 + 5 * (backlog // max(1, self.max_concurrency))
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "active": self.active,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)